@@ -1,30 +1,33 @@
+from asgiref.sync import sync_to_async
 from ninja import NinjaAPI, Router
-from ninja.responses import Response  # Correct import for Response
+from .renderers import FastJSONParser, FastJSONRenderer, Response
 from .schema import SignUpSchema, LoginSchema
 from django.contrib.auth.models import User
-from django.contrib.auth.hashers import make_password
-from django.contrib.auth import authenticate
+from django.contrib.auth.hashers import check_password, make_password
 from rest_framework_simplejwt.tokens import RefreshToken
 from .models import UserProfile
+from .avatars import aavatar_urls
+from .executor import run_blocking
+from .authentication import revoke
 from django.conf import settings
 
-auth_router = NinjaAPI(urls_namespace='authapi')
+auth_router = NinjaAPI(urls_namespace='authapi', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 # Define the signup route
 
 
 @auth_router.post("/signup", response={201: dict, 400: dict})
-def signup(request, payload: SignUpSchema):
+async def signup(request, payload: SignUpSchema):
     print("IN")
-    if User.objects.filter(username=payload.username).exists():
+    if await User.objects.filter(username=payload.username).aexists():
         return Response({"success": False, "message": "Username already taken"}, status=400)
 
-    if User.objects.filter(email=payload.email).exists():
+    if await User.objects.filter(email=payload.email).aexists():
         return Response({"success": False, "message": "Email already in use"}, status=400)
 
-    user = User.objects.create(
+    user = await User.objects.acreate(
         username=payload.username,
-        password=make_password(payload.password),
+        password=await run_blocking(make_password, payload.password),
         email=payload.email,
     )
 
@@ -34,9 +37,9 @@ def signup(request, payload: SignUpSchema):
     if payload.last_name:
         user_profile_data['last_name'] = payload.last_name
 
-    UserProfile.objects.create(user=user, **user_profile_data)
+    await UserProfile.objects.acreate(user=user, **user_profile_data)
 
-    refresh = RefreshToken.for_user(user)
+    refresh = await sync_to_async(RefreshToken.for_user)(user)
     return Response({
         "success": True,
         "message": "User created successfully",
@@ -49,36 +52,28 @@ def signup(request, payload: SignUpSchema):
 
 
 @auth_router.post("/login", response={200: dict, 401: dict, 404: dict})
-def login(request, payload: LoginSchema):
+async def login(request, payload: LoginSchema):
     username_or_email = payload.username_or_email
     password = payload.password
 
     if '@' in username_or_email:
         try:
-            user = User.objects.get(email=username_or_email)
-            user = authenticate(username=user.username, password=password)
-            if user is None:
-                return Response({"success": False, "message": "Invalid password"}, status=401)
+            user = await User.objects.aget(email=username_or_email)
         except User.DoesNotExist:
             return Response({"success": False, "message": "Email not found"}, status=404)
     else:
-        user = authenticate(username=username_or_email, password=password)
-        if user is None:
-            if User.objects.filter(username=username_or_email).exists():
-                return Response({"success": False, "message": "Invalid password"}, status=401)
-            else:
-                return Response({"success": False, "message": "Username not found"}, status=404)
-
-    refresh = RefreshToken.for_user(user)
-
-    try:
-        user_profile = UserProfile.objects.get(user=user)
-        profile_picture_url = (
-            user_profile.profile_image.url if user_profile.profile_image
-            else f"{settings.MEDIA_URL}profile_images/default.png"
-        )
-    except UserProfile.DoesNotExist:
-        profile_picture_url = f"{settings.MEDIA_URL}profile_images/default.png"
+        try:
+            user = await User.objects.aget(username=username_or_email)
+        except User.DoesNotExist:
+            return Response({"success": False, "message": "Username not found"}, status=404)
+
+    # Same checks as ModelBackend, with the slow hash comparison off the event loop.
+    if not (user.is_active and await run_blocking(check_password, password, user.password)):
+        return Response({"success": False, "message": "Invalid password"}, status=401)
+
+    refresh = await sync_to_async(RefreshToken.for_user)(user)
+
+    profile_picture_url = (await aavatar_urls([user.id]))[user.id]
 
     return Response({
         "success": True,
@@ -96,8 +91,7 @@ def logout(request):
     if auth_header and auth_header.startswith("Bearer "):
         token = auth_header.split(" ")[1]
         try:
-            refresh_token = RefreshToken(token)
-            refresh_token.blacklist()
+            revoke(token)
             return Response({"success": True, "message": "Logged out successfully"}, status=200)
         except Exception as e:
             return Response({"success": False, "message": "Invalid token or unable to blacklist"}, status=400)
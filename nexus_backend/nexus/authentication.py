@@ -0,0 +1,205 @@
+import copy
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Q
+from django.utils import timezone
+from ninja_extra.security import AsyncHttpBearer
+from ninja_jwt.authentication import JWTAuth
+from ninja_jwt.exceptions import AuthenticationFailed
+from ninja_jwt.settings import api_settings
+from ninja_jwt.utils import datetime_from_epoch
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+AUTH_USER_CACHE_TTL = getattr(settings, 'AUTH_USER_CACHE_TTL', 30)
+AUTH_USER_CACHE_SIZE = getattr(settings, 'AUTH_USER_CACHE_SIZE', 10000)
+AUTH_REVOCATION_REFRESH = getattr(settings, 'AUTH_REVOCATION_REFRESH', 5)
+AUTH_REVOCATION_GAP_TIMEOUT = getattr(settings, 'AUTH_REVOCATION_GAP_TIMEOUT', 60)
+
+
+class _UserCache:
+    """Users by id for a few seconds, so authenticated requests skip the user lookup."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            return entry[1]
+
+    def set(self, user_id, user):
+        with self.lock:
+            if len(self.entries) >= self.size:
+                now = time.monotonic()
+                self.entries = {key: entry for key, entry in self.entries.items() if entry[0] >= now}
+                if len(self.entries) >= self.size:
+                    self.entries.clear()
+            self.entries[user_id] = (time.monotonic() + self.ttl, user)
+
+    def forget(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class _RevocationList:
+    """Revoked JTIs mirrored from BlacklistedToken.
+
+    Only rows newer than the last one seen are fetched, and at most once
+    every AUTH_REVOCATION_REFRESH seconds, so checks are in-memory in the
+    steady state. Rows commit out of id order, so ids skipped over are
+    fetched again for AUTH_REVOCATION_GAP_TIMEOUT seconds in case their
+    transaction was still open.
+    """
+
+    def __init__(self, refresh_interval, gap_timeout):
+        self.refresh_interval = refresh_interval
+        self.gap_timeout = gap_timeout
+        self.expires = {}
+        self.last_id = 0
+        self.gaps = {}
+        self.next_refresh = 0
+        self.lock = threading.Lock()
+
+    def due(self):
+        return time.monotonic() >= self.next_refresh
+
+    def refresh(self, force=False):
+        with self.lock:
+            now = time.monotonic()
+            if not force and now < self.next_refresh:
+                return
+            self.next_refresh = now + self.refresh_interval
+
+            rows = BlacklistedToken.objects.filter(
+                Q(id__gt=self.last_id) | Q(id__in=list(self.gaps))).order_by('id').values_list(
+                'id', 'token__jti', 'token__expires_at')
+            for row_id, jti, expires_at in rows:
+                self.expires[jti] = expires_at
+                self.gaps.pop(row_id, None)
+                if row_id > self.last_id:
+                    # On the first load, earlier ids are rows compacted away rather than uncommitted.
+                    if self.last_id:
+                        self.gaps.update(dict.fromkeys(range(self.last_id + 1, row_id), now + self.gap_timeout))
+                    self.last_id = row_id
+            self.gaps = {row_id: deadline for row_id, deadline in self.gaps.items() if deadline > now}
+
+            current = timezone.now()
+            self.expires = {jti: expires_at for jti, expires_at in self.expires.items()
+                            if expires_at > current}
+
+    def add(self, jti, expires_at):
+        with self.lock:
+            self.expires[jti] = expires_at
+
+    def __contains__(self, jti):
+        return jti in self.expires
+
+    def clear(self):
+        with self.lock:
+            self.expires.clear()
+            self.last_id = 0
+            self.gaps.clear()
+            self.next_refresh = 0
+
+
+_users = _UserCache(AUTH_USER_CACHE_TTL, AUTH_USER_CACHE_SIZE)
+revoked = _RevocationList(AUTH_REVOCATION_REFRESH, AUTH_REVOCATION_GAP_TIMEOUT)
+
+
+class CachedJWTAuth(JWTAuth):
+    """JWTAuth that validates the token locally, serves the user from a
+    short-TTL in-process cache and rejects revoked tokens."""
+
+    def jwt_authenticate(self, request, token):
+        request.user = AnonymousUser()
+        validated_token = self.get_validated_token(token)
+        revoked.refresh()
+        self.check_revoked(validated_token)
+        user = self.get_user(validated_token)
+        request.user = user
+        return user
+
+    def check_revoked(self, validated_token):
+        if validated_token.get(api_settings.JTI_CLAIM) in revoked:
+            raise AuthenticationFailed("Token has been revoked")
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = _users.get(user_id)
+        if user is None:
+            user = super().get_user(validated_token)
+            _users.set(user_id, user)
+        # Handlers may modify request.user, so never hand out the shared instance.
+        return copy.copy(user)
+
+
+class AsyncCachedJWTAuth(CachedJWTAuth, AsyncHttpBearer):
+    """CachedJWTAuth for async handlers: only cache misses and due
+    revocation refreshes leave the event loop."""
+
+    async def authenticate(self, request, token):
+        request.user = AnonymousUser()
+        user = await self.token_user(token)
+        request.user = user
+        return user
+
+    async def token_user(self, token):
+        """User for a raw access token; raises AuthenticationFailed if it is invalid or revoked."""
+        validated_token = self.get_validated_token(token)
+        if revoked.due():
+            await sync_to_async(revoked.refresh)()
+        self.check_revoked(validated_token)
+
+        user = _users.get(validated_token.get(api_settings.USER_ID_CLAIM))
+        if user is None:
+            user = await sync_to_async(self.get_user)(validated_token)
+        else:
+            user = copy.copy(user)
+        return user
+
+
+def forget_user(user_id):
+    _users.forget(user_id)
+
+
+def revoke(raw_token):
+    """Blacklists an access token so CachedJWTAuth rejects it from now on."""
+    validated_token = CachedJWTAuth.get_validated_token(raw_token)
+    jti = validated_token[api_settings.JTI_CLAIM]
+    expires_at = datetime_from_epoch(validated_token["exp"])
+
+    outstanding, _ = OutstandingToken.objects.get_or_create(
+        jti=jti,
+        defaults={
+            "user_id": validated_token.get(api_settings.USER_ID_CLAIM),
+            "token": str(raw_token),
+            "expires_at": expires_at,
+        },
+    )
+    BlacklistedToken.objects.get_or_create(token=outstanding)
+    revoked.add(jti, expires_at)
+
+
+def compact_tokens(batch_size=1000):
+    """Deletes expired outstanding tokens (and their blacklist rows) in bounded batches."""
+    removed = 0
+    while True:
+        batch = list(OutstandingToken.objects.filter(
+            expires_at__lte=timezone.now()).order_by('id').values_list('id', flat=True)[:batch_size])
+        if not batch:
+            return removed
+        BlacklistedToken.objects.filter(token_id__in=batch).delete()
+        OutstandingToken.objects.filter(id__in=batch).delete()
+        removed += len(batch)
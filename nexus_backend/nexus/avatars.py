@@ -0,0 +1,84 @@
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.files.storage import default_storage
+from . import images
+from .models import UserProfile
+
+AVATAR_CACHE_SIZE = getattr(settings, 'AVATAR_CACHE_SIZE', 4096)
+DEFAULT_AVATAR_URL = f"{settings.MEDIA_URL}profile_images/default.png"
+
+
+class _LRU:
+    """Bounded, thread-safe map from (user_id, image name) to a resolved URL."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            url = self.entries.get(key)
+            if url is not None:
+                self.entries.move_to_end(key)
+            return url
+
+    def set(self, key, url):
+        with self.lock:
+            self.entries[key] = url
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def drop_user(self, user_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_urls = _LRU(AVATAR_CACHE_SIZE)
+
+
+def avatar_url(user_id, image_name, variants=None):
+    """URL for a user's avatar given the stored image name, without touching the database."""
+    if not image_name:
+        return DEFAULT_AVATAR_URL
+    # The image name is the version: a new upload changes the key.
+    key = (user_id, image_name, bool(variants))
+    url = _urls.get(key)
+    if url is None:
+        # Avatars render small, so the thumbnail is served once it has been generated.
+        url = images.image_url(variants, 'thumb', None) or default_storage.url(image_name)
+        _urls.set(key, url)
+    return url
+
+
+def profile_avatar_url(user_profile):
+    if user_profile is None:
+        return DEFAULT_AVATAR_URL
+    return avatar_url(user_profile.user_id, user_profile.profile_image.name, user_profile.image_variants)
+
+
+def avatar_urls(user_ids):
+    """Maps every given user id to an avatar URL using a single query."""
+    user_ids = set(user_ids)
+    stored = {user_id: (name, variants) for user_id, name, variants in UserProfile.objects.filter(
+        user_id__in=user_ids).values_list('user_id', 'profile_image', 'image_variants')}
+    return {user_id: avatar_url(user_id, *stored.get(user_id, (None,))) for user_id in user_ids}
+
+
+async def aavatar_urls(user_ids):
+    """Async avatar_urls, for handlers running on the event loop."""
+    user_ids = set(user_ids)
+    stored = {user_id: (name, variants) async for user_id, name, variants in UserProfile.objects.filter(
+        user_id__in=user_ids).values_list('user_id', 'profile_image', 'image_variants')}
+    return {user_id: avatar_url(user_id, *stored.get(user_id, (None,))) for user_id in user_ids}
+
+
+def invalidate(user_id):
+    _urls.drop_user(user_id)
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import re
+from functools import partial
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, transaction
+from ninja_jwt.exceptions import AuthenticationFailed
+from .authentication import AsyncCachedJWTAuth
+from .models import Conversation, Message
+from .pubsub import SubscriptionOverflow, backend
+from .renderers import dumps
+
+CHAT_SOCKET_PATH = re.compile(r'^/chat/ws/(?P<convo_id>\d+)/?$')
+
+# Close codes sent before the socket is accepted are surfaced as HTTP 403.
+CLOSE_NOT_FOUND = 4404
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_TOO_SLOW = 4408
+
+logger = logging.getLogger(__name__)
+
+_auth = AsyncCachedJWTAuth()
+
+
+def conversation_channel(convo_id):
+    return f'chat:{convo_id}'
+
+
+def message_event(message):
+    return {
+        "id": message.id,
+        "content": message.content,
+        "producer_id": message.producer_id,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def publish_message(message):
+    """Pushes a stored message to every socket open on its conversation."""
+    backend().publish(conversation_channel(message.belongs_in_id), message_event(message))
+
+
+def publish_after_commit(message):
+    """Publishes the message once it is committed; a pub/sub failure never fails the write."""
+    transaction.on_commit(partial(_publish_quietly, message))
+
+
+def _publish_quietly(message):
+    try:
+        publish_message(message)
+    except Exception:
+        # The message is stored, and sockets pick it up with after_id when they reconnect.
+        logger.exception("Could not publish message %s", message.id)
+
+
+async def send_event(send, event, user):
+    await send({'type': 'websocket.send', 'text': dumps({
+        "id": event["id"],
+        "content": event["content"],
+        "is_owner": event["producer_id"] == user.id,
+        "created_at": event["created_at"],
+    }).decode()})
+
+
+async def chat_socket(scope, receive, send):
+    """ASGI app for /chat/ws/<convo_id>?token=<access token>[&after_id=<message id>].
+
+    Streams messages added to the conversation as JSON text frames. With
+    after_id, messages stored after that id are replayed first, so a
+    reconnecting client picks up exactly where it left off.
+    """
+    if (await receive())['type'] != 'websocket.connect':
+        return
+
+    match = CHAT_SOCKET_PATH.match(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    convo_id = int(match['convo_id'])
+    params = parse_qs(scope.get('query_string', b'').decode())
+
+    try:
+        user = await _auth.token_user(params.get('token', [''])[0])
+    except AuthenticationFailed:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+
+    if not await Conversation.objects.filter(id=convo_id, users=user).aexists():
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+
+    # Subscribe before replaying so nothing published in between is lost.
+    subscription = await backend().subscribe(conversation_channel(convo_id))
+    try:
+        await send({'type': 'websocket.accept'})
+
+        replayed = set()
+        if params.get('after_id', [''])[0].isdigit():
+            missed = Message.objects.filter(belongs_in=convo_id, id__gt=int(params['after_id'][0])).order_by('id')
+            async for message in missed:
+                await send_event(send, message_event(message), user)
+                replayed.add(message.id)
+        await sync_to_async(close_old_connections)()
+
+        forwarder = asyncio.ensure_future(forward(subscription, send, user, replayed))
+        try:
+            while True:
+                # Frames from the client are ignored; messages are sent through add-message.
+                event = await _next_client_event(receive, forwarder)
+                if event is None or event['type'] == 'websocket.disconnect':
+                    break
+        finally:
+            forwarder.cancel()
+    finally:
+        await subscription.close()
+
+
+async def _next_client_event(receive, forwarder):
+    """Next frame from the client, or None once the forwarder has stopped."""
+    receiving = asyncio.ensure_future(receive())
+    await asyncio.wait({receiving, forwarder}, return_when=asyncio.FIRST_COMPLETED)
+    if receiving.done():
+        return receiving.result()
+    receiving.cancel()
+    return None
+
+
+async def forward(subscription, send, user, replayed):
+    """Sends live events to the socket, skipping those the replay already sent.
+
+    Messages commit, and so are published, in any id order; only ids seen in
+    the replay are duplicates.
+    """
+    try:
+        while True:
+            event = await subscription.get()
+            if event["id"] in replayed:
+                # Each message is published once, so its id is not needed after this.
+                replayed.discard(event["id"])
+                continue
+            await send_event(send, event, user)
+    except SubscriptionOverflow:
+        # The client reconnects with after_id and catches up from the database.
+        await send({'type': 'websocket.close', 'code': CLOSE_TOO_SLOW})
@@ -0,0 +1,27 @@
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from .models import Comment, Post
+
+
+def counted_likes():
+    return Coalesce(Subquery(
+        Post.likes_list.through.objects.filter(post_id=OuterRef('pk')).order_by()
+        .values('post_id').annotate(n=Count('pk')).values('n')), 0)
+
+
+def counted_comments():
+    return Coalesce(Subquery(
+        Comment.objects.filter(comment_post=OuterRef('pk')).order_by()
+        .values('comment_post').annotate(n=Count('pk')).values('n')), 0)
+
+
+def drifted_posts(posts=None):
+    """Posts whose stored counters disagree with the underlying rows."""
+    posts = Post.objects.all() if posts is None else posts
+    return posts.annotate(
+        actual_likes=counted_likes(), actual_comments=counted_comments()
+    ).filter(~Q(like_count=F('actual_likes')) | ~Q(comment_count=F('actual_comments')))
+
+
+def rebuild_counters(posts):
+    return posts.update(like_count=counted_likes(), comment_count=counted_comments())
@@ -0,0 +1,17 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.conf import settings
+
+BLOCKING_EXECUTOR_WORKERS = getattr(settings, 'BLOCKING_EXECUTOR_WORKERS', 4)
+
+_pool = ThreadPoolExecutor(max_workers=BLOCKING_EXECUTOR_WORKERS, thread_name_prefix='nexus-blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs password hashing, file writes and similar blocking work off the event loop.
+
+    At most BLOCKING_EXECUTOR_WORKERS calls run at once; the rest queue.
+    Nothing submitted here may touch the database, use the async ORM for that.
+    """
+    return await asyncio.get_running_loop().run_in_executor(_pool, partial(func, *args, **kwargs))
@@ -0,0 +1,63 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from . import images, media
+from .models import Story
+
+logger = logging.getLogger(__name__)
+
+STORY_EXPIRY_BATCH = getattr(settings, 'STORY_EXPIRY_BATCH', 500)
+STORY_MEDIA_DELETE_WORKERS = getattr(settings, 'STORY_MEDIA_DELETE_WORKERS', 8)
+
+
+def _delete_media(name):
+    try:
+        default_storage.delete(name)
+        return True
+    except Exception:
+        logger.exception("Could not delete story media %s", name)
+        return False
+
+
+def expire_stories(batch_size=STORY_EXPIRY_BATCH, workers=STORY_MEDIA_DELETE_WORKERS, after_id=0, progress=None):
+    """Deletes stories that expired before the run started, in story id order.
+
+    Each chunk deletes its media files through a thread pool and then its
+    rows, so an interrupted run only ever leaves rows whose files may already
+    be gone, and running again finishes the job. A story whose file could not
+    be deleted keeps its row for the next run. Stories stored as shared blobs
+    release their reference together with the row, and a blob is only
+    deleted once nothing references it; blobs whose files could not be
+    deleted are collected again at the start of every run, and blob files are
+    only deleted once the rows releasing them have committed. progress, if
+    given, is called with the last story id of every chunk, which can be
+    passed back as after_id to resume. Returns the number of stories removed.
+    """
+    moment = timezone.now()
+    removed = 0
+    # Inside a caller's transaction, blobs are only collected once it commits, after this pool is gone.
+    in_transaction = transaction.get_connection().in_atomic_block
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='nexus-expiry') as pool:
+        release_pool = None if in_transaction else pool
+        media.collect_blobs(pool=pool)
+        while True:
+            chunk = list(Story.objects.filter(expires_at__lte=moment, story_id__gt=after_id)
+                         .order_by('story_id').values_list('story_id', 'story_image', 'image_variants')[:batch_size])
+            if not chunk:
+                return removed
+            # Files uploaded before blobs belong to their story alone.
+            files = [(story_id, name) for story_id, image, variants in chunk if image and not media.is_blob(image)
+                     for name in [image, *images.variant_files(variants)]]
+            failed = {story_id for (story_id, _), deleted in zip(
+                files, pool.map(_delete_media, [name for _, name in files])) if not deleted}
+            expired = [story_id for story_id, _, _ in chunk if story_id not in failed]
+            with transaction.atomic():
+                Story.objects.filter(story_id__in=expired).delete()
+                media.release(*(image for story_id, image, _ in chunk if story_id not in failed), pool=release_pool)
+            removed += len(expired)
+            after_id = chunk[-1][0]
+            if progress is not None:
+                progress(after_id)
@@ -0,0 +1,156 @@
+import time
+from datetime import datetime
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.timesince import timesince
+from .timeline import follower_ids, is_pull_author
+
+FEED_CACHE_ALIAS = getattr(settings, 'FEED_CACHE_ALIAS', 'default')
+FEED_CACHE_TIMEOUT = getattr(settings, 'FEED_CACHE_TIMEOUT', 300)
+FEED_CACHE_INVALIDATION_BATCH = getattr(settings, 'FEED_CACHE_INVALIDATION_BATCH', 1000)
+
+HITS_KEY = 'feed:stats:hits'
+MISSES_KEY = 'feed:stats:misses'
+
+
+def _cache():
+    return caches[FEED_CACHE_ALIAS]
+
+
+def _version_key(viewer_id):
+    return f'feed:v:{viewer_id}'
+
+
+def _author_key(author_id):
+    return f'feed:author:{author_id}'
+
+
+def _page_key(viewer_id, version, cursor, limit):
+    return f'feed:page:{viewer_id}:{version}:{cursor or "head"}:{limit}'
+
+
+def _likes_key(post_id):
+    return f'feed:likes:{post_id}'
+
+
+def _comments_key(post_id):
+    return f'feed:comments:{post_id}'
+
+
+def _incr(key):
+    cache = _cache()
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        return cache.incr(key)
+
+
+def _version(viewer_id):
+    cache = _cache()
+    version = cache.get(_version_key(viewer_id))
+    if version is None:
+        # Start from a fresh value so pages written under an evicted
+        # version can never be served again.
+        cache.add(_version_key(viewer_id), time.time_ns(), timeout=None)
+        version = cache.get(_version_key(viewer_id))
+    return version
+
+
+def author_versions(author_ids):
+    """Versions of the posts of authors who fan out on read, to store with a page built from them.
+
+    Taken before the page is read from the database, so a post landing in
+    between leaves the page stale rather than served.
+    """
+    cache = _cache()
+    versions = cache.get_many([_author_key(author_id) for author_id in author_ids])
+    missing = [_author_key(author_id) for author_id in author_ids if _author_key(author_id) not in versions]
+    if missing:
+        for key in missing:
+            cache.add(key, time.time_ns(), timeout=None)
+        versions.update(cache.get_many(missing))
+    return {author_id: versions[_author_key(author_id)] for author_id in author_ids}
+
+
+def get_page(viewer_id, cursor, limit):
+    """Returns the cached feed page for this viewer and cursor, or None.
+
+    Like and comment counts are patched in from the per-post overlays
+    written by patch_like_count and patch_comment_count, so neither forces a
+    page rebuild. Posts of
+    authors who fan out on read are not pushed to each viewer; the page is
+    dropped instead once any of their versions moved on.
+    """
+    cache = _cache()
+    page = cache.get(_page_key(viewer_id, _version(viewer_id), cursor, limit))
+    stored_versions = page.pop("author_versions", {}) if page is not None else {}
+    if stored_versions:
+        current = cache.get_many([_author_key(author_id) for author_id in stored_versions])
+        if any(current.get(_author_key(author_id)) != version for author_id, version in stored_versions.items()):
+            page = None
+    if page is None:
+        _incr(MISSES_KEY)
+        return None
+
+    _incr(HITS_KEY)
+    overlay = cache.get_many([key(post["id"]) for post in page["posts"] for key in (_likes_key, _comments_key)])
+    for post in page["posts"]:
+        post["likes_count"] = overlay.get(_likes_key(post["id"]), post["likes_count"])
+        post["comments_count"] = overlay.get(_comments_key(post["id"]), post["comments_count"])
+        post["time_lapsed"] = timesince(datetime.fromisoformat(post["created_at"]))
+    return page
+
+
+def set_page(viewer_id, cursor, limit, page, pulled_versions=None):
+    """Caches a page; pulled_versions comes from author_versions for the pull authors merged into it."""
+    if pulled_versions:
+        page = {**page, "author_versions": pulled_versions}
+    _cache().set(_page_key(viewer_id, _version(viewer_id), cursor, limit), page, FEED_CACHE_TIMEOUT)
+
+
+def invalidate_viewers(viewer_ids):
+    """Moves each viewer to a fresh version, FEED_CACHE_INVALIDATION_BATCH keys per cache round trip."""
+    viewer_ids = list(viewer_ids)
+    version = time.time_ns()
+    for start in range(0, len(viewer_ids), FEED_CACHE_INVALIDATION_BATCH):
+        _cache().set_many({_version_key(viewer_id): version
+                           for viewer_id in viewer_ids[start:start + FEED_CACHE_INVALIDATION_BATCH]}, timeout=None)
+
+
+def invalidate_author(author):
+    """Drops cached feeds of everyone who can see the author's posts.
+
+    Followers of an author who fans out on read hold the author's version
+    in their pages instead, so that costs one write however many follow.
+    """
+    if is_pull_author(author):
+        _cache().set(_author_key(author.id), time.time_ns(), timeout=None)
+        invalidate_viewers([author.id])
+    else:
+        # Bounded by TIMELINE_FANOUT_FOLLOWER_LIMIT, past which authors fan out on read.
+        invalidate_viewers(list(follower_ids(author)) + [author.id])
+
+
+def patch_like_count(post_id, like_count):
+    _cache().set(_likes_key(post_id), like_count, FEED_CACHE_TIMEOUT)
+
+
+def patch_comment_count(post_id, comment_count):
+    _cache().set(_comments_key(post_id), comment_count, FEED_CACHE_TIMEOUT)
+
+
+def stats():
+    cache = _cache()
+    counts = cache.get_many([HITS_KEY, MISSES_KEY])
+    hits, misses = counts.get(HITS_KEY, 0), counts.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / lookups if lookups else 0.0,
+    }
+
+
+def reset_stats():
+    _cache().delete_many([HITS_KEY, MISSES_KEY])
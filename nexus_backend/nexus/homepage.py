@@ -1,67 +1,123 @@
 import os
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db.models import Exists, OuterRef
 from ninja import NinjaAPI, Schema
-from ninja.responses import Response
+from .renderers import FastJSONParser, FastJSONRenderer, Response
 from rest_framework.permissions import IsAuthenticated
-from .models import Post, UserProfile
-from ninja_jwt.authentication import JWTAuth
+from .models import Post, TimelineEntry, UserProfile
+from .authentication import AsyncCachedJWTAuth
 from .schema import PostSchema
 from django.utils.timesince import timesince
+from .pagination import clamp_limit, decode_cursor, encode_cursor, keyset_before
+from .timeline import pull_author_ids
+from . import feed_cache, images
+from .avatars import profile_avatar_url
 from .posts import post_router
 
-hp_router = NinjaAPI(urls_namespace='HPapi')
+hp_router = NinjaAPI(urls_namespace='HPapi', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 
-@hp_router.get("/posts", auth=JWTAuth())
-def get_homepage_posts(request) -> Response:
+@hp_router.get("/posts", auth=AsyncCachedJWTAuth())
+async def get_homepage_posts(request, before: str = None, limit: int = None) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    try:
-        user_profile = UserProfile.objects.get(user=request.user)
-    except UserProfile.DoesNotExist:
+    limit = clamp_limit(limit)
+
+    cached_page = await sync_to_async(feed_cache.get_page)(request.user.id, before, limit)
+    if cached_page is not None:
+        return Response(cached_page, status=200)
+
+    if not await UserProfile.objects.filter(user=request.user).aexists():
         return Response({"error": "User profile does not exist."}, status=404)
 
-    following_users = user_profile.following.all()
+    cursor = None
+    if before:
+        try:
+            cursor = decode_cursor(before)
+        except ValueError:
+            return Response({"error": "Invalid cursor"}, status=400)
+
+    pull_ids = [user_id async for user_id in pull_author_ids(request.user)]
+    pulled_versions = await sync_to_async(feed_cache.author_versions)(pull_ids)
+    # One extra row tells us whether another page exists.
+    page = await feed_posts(request.user, cursor, limit + 1, pull_ids)
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].post_date, page[-1].post_id)
 
-    following_and_self = list(following_users) + [request.user]
+    response_data = [serialize_feed_post(post, request.user) for post in page]
+    feed_page = {"posts": response_data, "next_cursor": next_cursor}
+    await sync_to_async(feed_cache.set_page)(request.user.id, before, limit, feed_page, pulled_versions)
 
-    posts = Post.objects.filter(
-        user_id__in=following_and_self).order_by('-post_date')
+    return Response(feed_page, status=200)
 
 
-    response_data = []
-    for post in posts:
-        post_image_url = None
-        if post.post_image:
-            post_image_url = os.path.join(
-                settings.MEDIA_URL, f'posts/{post.post_id}.{post.post_image.name.split(".")[-1]}')
+async def feed_posts(viewer, cursor, count, pull_ids):
+    """Up to count posts from everyone the viewer follows plus their own, newest first.
 
-        likes_count = post.likes_list.count()
-        current_user_has_liked = False
-        if (post.likes_list.filter(id=request.user.id).exists()):
-            current_user_has_liked = True
+    Posts come from the viewer's materialized timeline, walked in index order,
+    merged with the posts of pull_ids, the followed authors who fan out on
+    read. Counts are read from the denormalized Post columns, and the
+    viewer's like and the author's profile are resolved in the same query,
+    so a page costs a fixed number of queries regardless of size.
+    """
+    entries = (
+        TimelineEntry.objects
+        .filter(owner=viewer)
+        .select_related('post__user_id__userprofile')
+        .annotate(has_liked=liked_by(viewer, 'post_id'))
+        .order_by('-post_date', '-post_id')
+    )
+    if cursor:
+        entries = entries.filter(keyset_before('post_date', 'post_id', *cursor))
 
-        friend_profile = UserProfile.objects.get(user=post.user_id)
+    posts = []
+    async for entry in entries[:count]:
+        entry.post.has_liked = entry.has_liked
+        posts.append(entry.post)
 
-        profile_picture_url = (
-            friend_profile.profile_image.url if friend_profile.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
+    if pull_ids:
+        pulled = (
+            Post.objects
+            .filter(user_id__in=pull_ids)
+            .select_related('user_id__userprofile')
+            .annotate(has_liked=liked_by(viewer, 'pk'))
+            .order_by('-post_date', '-post_id')
         )
+        if cursor:
+            pulled = pulled.filter(keyset_before('post_date', 'post_id', *cursor))
+        merged = {post.post_id: post for post in posts + [post async for post in pulled[:count]]}
+        posts = sorted(merged.values(), key=lambda post: (post.post_date, post.post_id), reverse=True)
+
+    return posts[:count]
+
+
+def liked_by(viewer, post_ref):
+    return Exists(Post.likes_list.through.objects.filter(
+        post_id=OuterRef(post_ref), user_id=viewer.id))
+
+
+def serialize_feed_post(post, viewer):
+    post_image_url = None
+    if post.post_image:
+        post_image_url = images.image_url(post.image_variants, 'full', post.post_image.url)
+
+    profile_picture_url = profile_avatar_url(getattr(post.user_id, 'userprofile', None))
 
-        time_ago = timesince(post.post_date)
-
-        response_data.append({
-            "id": post.post_id,
-            "user": post.user_id.username,
-            "post_image": post_image_url,
-            "created_at": post.post_date.isoformat(),
-            "caption": post.caption,
-            "likes_count": likes_count,
-            "has_liked": current_user_has_liked,
-            "profile_picture": profile_picture_url,
-            "time_lapsed": time_ago,
-            "is_owner": True if post.user_id == request.user else False
-        })
-
-    return Response(response_data, status=200)
+    return {
+        "id": post.post_id,
+        "user": post.user_id.username,
+        "post_image": post_image_url,
+        "post_image_variants": images.variant_urls(post.image_variants),
+        "created_at": post.post_date.isoformat(),
+        "caption": post.caption,
+        "likes_count": post.like_count,
+        "comments_count": post.comment_count,
+        "has_liked": post.has_liked,
+        "profile_picture": profile_picture_url,
+        "time_lapsed": timesince(post.post_date),
+        "is_owner": post.user_id_id == viewer.id
+    }
@@ -0,0 +1,311 @@
+import logging
+import os
+import warnings
+from functools import partial
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import FileResponse, HttpResponse
+from django.urls import reverse
+from ninja import NinjaAPI
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+from .models import MediaBlob, Post, Story, UserProfile
+from .renderers import FastJSONRenderer
+
+logger = logging.getLogger(__name__)
+
+# Longest side in pixels of each generated variant.
+MEDIA_VARIANTS = getattr(settings, 'MEDIA_VARIANTS', {'thumb': 150, 'medium': 640, 'full': 1080})
+# Larger sources are refused before any pixel data is decoded.
+MEDIA_MAX_PIXELS = getattr(settings, 'MEDIA_MAX_PIXELS', 40_000_000)
+MEDIA_VARIANT_QUALITY = getattr(settings, 'MEDIA_VARIANT_QUALITY', 85)
+# Encodings of every variant, most preferred first. JPEG is always kept as
+# the fallback for clients that accept nothing better.
+MEDIA_VARIANT_FORMATS = getattr(settings, 'MEDIA_VARIANT_FORMATS', ['avif', 'webp', 'jpeg'])
+MEDIA_VARIANT_MAX_AGE = getattr(settings, 'MEDIA_VARIANT_MAX_AGE', 24 * 60 * 60)
+
+# Pillow format, file extension, content type and encoder options of each encoding.
+ENCODINGS = {
+    'avif': ('AVIF', 'avif', 'image/avif', {'quality': MEDIA_VARIANT_QUALITY - 25, 'speed': 8}),
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': MEDIA_VARIANT_QUALITY - 5, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': MEDIA_VARIANT_QUALITY, 'optimize': True, 'progressive': True}),
+}
+
+
+def available_formats():
+    """The configured encodings this Pillow build can write, JPEG last."""
+    formats = [fmt for fmt in MEDIA_VARIANT_FORMATS
+               if fmt in ENCODINGS and fmt != 'jpeg' and features.check(fmt)]
+    return formats + ['jpeg']
+
+
+# The models holding uploaded images, by the kind name used in task arguments.
+SOURCES = {
+    'post': (Post, 'post_image'),
+    'story': (Story, 'story_image'),
+    'avatar': (UserProfile, 'profile_image'),
+}
+
+
+class ImageRejected(ValueError):
+    """The source is not an image we are willing to decode."""
+
+
+def variant_stem(name, variant):
+    return f'{os.path.splitext(name)[0]}.{variant}'
+
+
+def variant_name(name, variant, fmt='jpeg'):
+    return f'{variant_stem(name, variant)}.{ENCODINGS[fmt][1]}'
+
+
+def variant_formats(entry):
+    """{format: stored name} of one variant; rows from before per-format variants hold a JPEG name."""
+    return {'jpeg': entry} if isinstance(entry, str) else entry
+
+
+def open_image(file):
+    """Opens an image after checking its dimensions, which only needs the header."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        try:
+            image = Image.open(file)
+        except (UnidentifiedImageError, Image.DecompressionBombError, Image.DecompressionBombWarning) as e:
+            raise ImageRejected(str(e)) from e
+    if image.width * image.height > MEDIA_MAX_PIXELS:
+        raise ImageRejected(f'{image.width}x{image.height} exceeds {MEDIA_MAX_PIXELS} pixels')
+    return image
+
+
+# Modes whose embedded colour profile still describes the RGB variants.
+RGB_MODES = ('RGB', 'RGBA', 'P', 'PA')
+
+
+def to_srgb(image, icc_profile):
+    """image converted to sRGB through its embedded profile; unchanged if the profile is unusable."""
+    try:
+        from PIL import ImageCms
+    except ImportError:
+        return image
+    try:
+        profile = ImageCms.ImageCmsProfile(BytesIO(icc_profile))
+        return ImageCms.profileToProfile(image, profile, ImageCms.createProfile('sRGB'), outputMode='RGB')
+    except (ImageCms.PyCMSError, OSError, ValueError):
+        logger.warning("Ignoring unusable %s colour profile", image.mode)
+        return image
+
+
+def render_variants(file, formats=None):
+    """Encoded bytes of every variant of the image in file, as {variant: {format: bytes}}.
+
+    JPEG sources are decoded at the smallest scale that still covers the
+    largest variant, and each variant is reduced from the next larger one,
+    so memory stays proportional to the output rather than the upload.
+    Metadata is dropped: only the pixels and an RGB colour profile are encoded.
+    """
+    formats = formats or available_formats()
+    sizes = sorted(MEDIA_VARIANTS.items(), key=lambda item: item[1], reverse=True)
+    with open_image(file) as source:
+        source.draft('RGB', (sizes[0][1], sizes[0][1]))
+        image = ImageOps.exif_transpose(source)
+        icc_profile = source.info.get('icc_profile')
+        if icc_profile and image.mode not in RGB_MODES:
+            # The profile describes the source's colour space (CMYK, grey), not the
+            # RGB variants, so it is applied here rather than embedded.
+            image = to_srgb(image, icc_profile)
+            icc_profile = None
+        if image.mode != 'RGB':
+            background = Image.new('RGB', image.size, 'white')
+            image = image.convert('RGBA')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+    # EXIF (location, camera, timestamps) must never reach a variant.
+    image.info = {}
+
+    rendered = {}
+    for variant, size in sizes:
+        image = image.copy()
+        image.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+        rendered[variant] = {}
+        for fmt in formats:
+            pillow_format, _, _, options = ENCODINGS[fmt]
+            out = BytesIO()
+            image.save(out, pillow_format, icc_profile=icc_profile, **options)
+            rendered[variant][fmt] = out.getvalue()
+    return rendered
+
+
+def generate_variants(name):
+    """Renders and stores the variants of a stored image; returns {variant: {format: stored name}}.
+
+    Touches storage only, never the database, so it can run in worker processes.
+    """
+    with default_storage.open(name, 'rb') as file:
+        rendered = render_variants(file)
+    variants = {}
+    for variant, encoded in rendered.items():
+        variants[variant] = {}
+        for fmt, data in encoded.items():
+            target = variant_name(name, variant, fmt)
+            if default_storage.exists(target):
+                default_storage.delete(target)
+            variants[variant][fmt] = default_storage.save(target, ContentFile(data))
+    return variants
+
+
+def variant_files(variants):
+    """Every stored file of a row's image_variants."""
+    return [name for entry in (variants or {}).values() for name in variant_formats(entry).values()]
+
+
+def delete_variants(variants):
+    for name in variant_files(variants):
+        default_storage.delete(name)
+
+
+def delete_variants_of(name):
+    """Deletes every variant that may have been rendered from the stored image name."""
+    for variant in MEDIA_VARIANTS:
+        for fmt in ENCODINGS:
+            default_storage.delete(variant_name(name, variant, fmt))
+
+
+def negotiated_url(entry):
+    # Every encoding of a variant shares a stem; the media view picks one per request.
+    stem = os.path.splitext(variant_formats(entry)['jpeg'])[0]
+    return reverse('imageAPI:variant', kwargs={'stem': stem})
+
+
+def variant_urls(variants):
+    """{variant: URL} for a row's image_variants; empty until they have been generated.
+
+    The URLs are the same for every client, so serialized pages stay cacheable,
+    and are answered in the best format the client's Accept header allows.
+    """
+    return {variant: negotiated_url(entry) for variant, entry in (variants or {}).items()}
+
+
+def image_url(variants, variant, fallback):
+    """URL of one variant once it has been generated, otherwise fallback (usually the original)."""
+    entry = (variants or {}).get(variant)
+    return negotiated_url(entry) if entry else fallback
+
+
+def record_variants(kind, pk, name, variants):
+    model, field = SOURCES[kind]
+    # The image may have been replaced meanwhile; the replacement has its own task.
+    updated = model.objects.filter(pk=pk, **{field: name}).update(image_variants=variants)
+    if not updated:
+        from . import media
+
+        # Variants of a shared blob go with the blob itself, see media.delete_blob_files.
+        if not media.is_blob(name) or not MediaBlob.objects.filter(name=name).exists():
+            delete_variants(variants)
+        return
+    if kind == 'post':
+        from . import feed_cache
+
+        feed_cache.invalidate_author(Post.objects.get(pk=pk).user_id)
+    elif kind == 'avatar':
+        from . import avatars
+
+        avatars.invalidate(UserProfile.objects.filter(pk=pk).values_list('user_id', flat=True).get())
+
+
+def known_variants(name):
+    """Variants already rendered for the same stored image by another row, if any.
+
+    Rows share a stored image when they uploaded identical bytes, see media.store_upload.
+    """
+    for model, field in SOURCES.values():
+        variants = (model.objects.filter(**{field: name}).exclude(image_variants={})
+                    .values_list('image_variants', flat=True).first())
+        if variants:
+            return variants
+    return None
+
+
+def process(kind, pk):
+    """Generates and records the variants of one row's image."""
+    model, field = SOURCES[kind]
+    name = model.objects.filter(pk=pk).values_list(field, flat=True).first()
+    if not name:
+        return None
+    try:
+        variants = known_variants(name) or generate_variants(name)
+    except ImageRejected as e:
+        logger.warning("Not generating variants of %s: %s", name, e)
+        return None
+    record_variants(kind, pk, name, variants)
+    return variants
+
+
+def schedule(kind, pk):
+    """Queues variant generation for a freshly uploaded image once the upload is committed."""
+    # Read per call so tests can switch modes with override_settings.
+    if getattr(settings, 'MEDIA_VARIANTS_EAGER', False):
+        try:
+            process(kind, pk)
+        except Exception:
+            logger.exception("Could not generate variants for %s %s", kind, pk)
+    else:
+        transaction.on_commit(partial(_enqueue, kind, pk))
+
+
+def _enqueue(kind, pk):
+    from .tasks import generate_image_variants
+
+    try:
+        generate_image_variants.delay(kind, pk)
+    except Exception:
+        # The original is still served; generate_image_variants backfills rows without variants.
+        logger.exception("Could not schedule variants for %s %s", kind, pk)
+
+
+image_router = NinjaAPI(urls_namespace='imageAPI', renderer=FastJSONRenderer())
+
+
+def accepted_types(accept):
+    """Media types the Accept header names explicitly, without those refused with q=0."""
+    types = set()
+    for part in accept.split(','):
+        media_type, *params = [piece.strip() for piece in part.split(';')]
+        quality = next((param[2:] for param in params if param.startswith('q=')), '1')
+        try:
+            refused = float(quality) <= 0
+        except ValueError:
+            refused = False
+        if not refused:
+            types.add(media_type.lower())
+    return types
+
+
+def choose_format(accept):
+    """Best encoding for a client. Wildcards do not count: a client that has
+    not named AVIF or WebP gets JPEG, which every client can decode."""
+    accepted = accepted_types(accept)
+    for fmt in available_formats():
+        if ENCODINGS[fmt][2] in accepted:
+            return fmt
+    return 'jpeg'
+
+
+@image_router.get('/{path:stem}', url_name='variant')
+def serve_variant(request, stem: str):
+    # Stems are generated names, never user input, so anything else is simply not found.
+    if stem.startswith('/') or '..' in stem.split('/') or stem.rsplit('.', 1)[-1] not in MEDIA_VARIANTS:
+        return HttpResponse(status=404)
+    preferred = choose_format(request.headers.get('Accept', ''))
+    for fmt in dict.fromkeys([preferred, 'jpeg']):
+        _, extension, content_type, _ = ENCODINGS[fmt]
+        try:
+            file = default_storage.open(f'{stem}.{extension}', 'rb')
+        except FileNotFoundError:
+            continue
+        response = FileResponse(file, content_type=content_type)
+        response['Vary'] = 'Accept'
+        response['Cache-Control'] = f'public, max-age={MEDIA_VARIANT_MAX_AGE}'
+        return response
+    return HttpResponse(status=404)
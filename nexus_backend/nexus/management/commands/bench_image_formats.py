@@ -0,0 +1,70 @@
+import os
+import random
+from io import BytesIO
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageDraw, ImageFilter
+from nexus import images
+from nexus.pagination import DEFAULT_PAGE_SIZE
+
+EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def synthetic_photo(seed, size=(2400, 1600)):
+    # Smooth gradients, shapes and sensor noise, saved the way phones do: high quality JPEG with EXIF.
+    rng = random.Random(seed)
+    bands = [Image.linear_gradient('L').rotate(rng.randrange(360)).resize(size) for _ in range(3)]
+    image = Image.merge('RGB', bands)
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        r = rng.randrange(50, 400)
+        draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randrange(256) for _ in range(3)))
+    image = image.filter(ImageFilter.GaussianBlur(3))
+    noise = Image.effect_noise(size, 12).convert('RGB')
+    image = Image.blend(image, noise, 0.08)
+    exif = Image.Exif()
+    exif[0x010F] = 'Bench camera'
+    exif[0x0132] = '2024:01:01 12:00:00'
+    out = BytesIO()
+    image.save(out, 'JPEG', quality=92, exif=exif.tobytes())
+    return out.getvalue()
+
+
+def corpus(directory, count):
+    if directory is None:
+        return [synthetic_photo(seed) for seed in range(count)]
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(EXTENSIONS))
+    if not names:
+        raise CommandError(f'No images in {directory}')
+    files = []
+    for name in names[:count]:
+        with open(os.path.join(directory, name), 'rb') as file:
+            files.append(file.read())
+    return files
+
+
+class Command(BaseCommand):
+    help = 'Compares the image bytes of one feed page served as uploaded and as negotiated variants'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='Directory of sample images (default: generated photos)')
+        parser.add_argument('--posts', type=int, default=DEFAULT_PAGE_SIZE, help='Posts per feed page')
+
+    def handle(self, *args, **kwargs):
+
+        formats = images.available_formats()
+        uploads = corpus(kwargs['corpus'], kwargs['posts'])
+        # Each feed entry shows the post image and its author's avatar; the sample stands in for both.
+        original = 0
+        served = dict.fromkeys(formats, 0)
+        for upload in uploads:
+            rendered = images.render_variants(BytesIO(upload), formats)
+            original += 2 * len(upload)
+            for fmt in formats:
+                served[fmt] += len(rendered['full'][fmt]) + len(rendered['thumb'][fmt])
+
+        self.stdout.write(f'{len(uploads)} posts per page, as uploaded {original / 1024:10.0f} KB')
+        for fmt in formats:
+            self.stdout.write(f'{fmt:>5} clients {served[fmt] / 1024:16.0f} KB, '
+                              f'{100 * (1 - served[fmt] / original):5.1f}% less than uploaded, '
+                              f'{100 * (1 - served[fmt] / served["jpeg"]):5.1f}% less than JPEG variants')
@@ -0,0 +1,50 @@
+import json
+import timeit
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ninja.responses import NinjaJSONEncoder
+from nexus import renderers
+
+
+def feed_payload(size):
+    now = timezone.now()
+    posts = []
+    for i in range(size):
+        created = now - timedelta(minutes=i * 7)
+        posts.append({
+            "id": 100000 + i,
+            "user": f"user_{i % 37}",
+            "post_image": f"/media/posts/{100000 + i}.jpg",
+            "created_at": created,
+            "caption": "Golden hour at the lake ☀️ #nofilter " * 3,
+            "likes_count": i * 13 % 997,
+            "comments_count": i * 7 % 89,
+            "has_liked": bool(i % 3),
+            "profile_picture": f"/media/profile_images/{i % 37}.jpg",
+            "time_lapsed": f"{i * 7} minutes",
+            "is_owner": False,
+        })
+    return {"posts": posts, "next_cursor": "MjAyNC0xMi0wM1QxMjowMDowMHwxMjM0NQ=="}
+
+
+class Command(BaseCommand):
+    help = 'Compares the default ninja JSON renderer with the fast renderer on feed payloads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--number', type=int, default=200)
+
+    def handle(self, *args, **kwargs):
+
+        number = kwargs['number']
+        backend = "orjson" if renderers.orjson is not None else "stdlib fallback"
+        self.stdout.write(f'Fast renderer backend: {backend}')
+
+        for size in (20, 50, 200):
+            payload = feed_payload(size)
+            default = timeit.timeit(
+                lambda: json.dumps(payload, cls=NinjaJSONEncoder).encode(), number=number)
+            fast = timeit.timeit(lambda: renderers.dumps(payload), number=number)
+            self.stdout.write(
+                f'{size:>4} posts: default {default / number * 1e6:8.1f} us, '
+                f'fast {fast / number * 1e6:8.1f} us, {default / fast:5.1f}x')
@@ -0,0 +1,140 @@
+import asyncio
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+from ninja_jwt.tokens import AccessToken
+
+DEFAULT_PATHS = [
+    '/homepage/posts',
+    '/story/friends-stories',
+    '/user/view-notifications',
+    '/chat/chats-preview',
+]
+
+
+def wsgi_get(application, path, authorization):
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'HTTP_HOST': 'localhost',
+        'HTTP_AUTHORIZATION': authorization,
+        'wsgi.input': io.BytesIO(b''),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    statuses = []
+    body = application(environ, lambda status, headers: statuses.append(status))
+    try:
+        b''.join(body)
+    finally:
+        body.close()
+    return int(statuses[0].split()[0])
+
+
+async def asgi_get(application, path, authorization):
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'host', b'localhost'), (b'authorization', authorization.encode())],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    request_sent = False
+    done = asyncio.Event()
+    statuses = []
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+        elif not message.get('more_body'):
+            done.set()
+
+    await application(scope, receive, send)
+    return statuses[0]
+
+
+class Command(BaseCommand):
+    help = 'Compares requests per second of the WSGI and ASGI applications on read endpoints under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User to authenticate the requests as')
+        parser.add_argument('--requests', type=int, default=400)
+        parser.add_argument('--concurrency', type=int, default=32)
+        parser.add_argument('--path', action='append', dest='paths',
+                            help=f'Endpoint to load, repeatable (default: {", ".join(DEFAULT_PATHS)})')
+
+    def handle(self, *args, **kwargs):
+
+        try:
+            user = User.objects.get(username=kwargs['username'])
+        except User.DoesNotExist:
+            raise CommandError(f'User {kwargs["username"]} does not exist')
+
+        authorization = f'Bearer {AccessToken.for_user(user)}'
+        number = kwargs['requests']
+        concurrency = kwargs['concurrency']
+        self.stdout.write(f'{number} requests per endpoint, {concurrency} concurrent')
+
+        for path in kwargs['paths'] or DEFAULT_PATHS:
+            wsgi_rps, wsgi_errors = self.run_wsgi(path, authorization, number, concurrency)
+            asgi_rps, asgi_errors = asyncio.run(self.run_asgi(path, authorization, number, concurrency))
+            self.stdout.write(
+                f'{path:<28} wsgi {wsgi_rps:8.1f} req/s, asgi {asgi_rps:8.1f} req/s, '
+                f'{asgi_rps / wsgi_rps:5.2f}x')
+            if wsgi_errors or asgi_errors:
+                self.stdout.write(f'{"":<28} non-200 responses: wsgi {wsgi_errors}, asgi {asgi_errors}')
+
+    def run_wsgi(self, path, authorization, number, concurrency):
+        application = get_wsgi_application()
+
+        def worker(_):
+            try:
+                return wsgi_get(application, path, authorization)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            statuses = list(pool.map(worker, range(number)))
+        elapsed = time.perf_counter() - started
+        return number / elapsed, sum(status != 200 for status in statuses)
+
+    async def run_asgi(self, path, authorization, number, concurrency):
+        application = get_asgi_application()
+        slots = asyncio.Semaphore(concurrency)
+
+        async def worker():
+            async with slots:
+                return await asgi_get(application, path, authorization)
+
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*[worker() for _ in range(number)])
+        elapsed = time.perf_counter() - started
+        return number / elapsed, sum(status != 200 for status in statuses)
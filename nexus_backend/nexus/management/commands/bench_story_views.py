@@ -0,0 +1,66 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from nexus import story_views
+from nexus.models import Story
+
+
+def per_request_view(story_id, user_id):
+    # What view-story did before buffering: an existence check, the insert and a save.
+    story = Story.objects.get(pk=story_id)
+    if not story.viewed_by.filter(id=user_id).exists():
+        story.viewed_by.add(user_id)
+        story.save()
+
+
+class Command(BaseCommand):
+    help = 'Compares story view throughput of per-request writes and the write-behind buffer under a view storm'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--viewers', type=int, default=1000, help='Distinct users viewing the story')
+        parser.add_argument('--concurrency', type=int, default=32)
+
+    def handle(self, *args, **kwargs):
+
+        # A throwaway story and viewers, so no real views are touched.
+        prefix = f'bench-{uuid.uuid4().hex[:8]}'
+        User.objects.bulk_create([User(username=f'{prefix}-{i}') for i in range(kwargs['viewers'] + 1)])
+        users = User.objects.filter(username__startswith=f'{prefix}-')
+        try:
+            author, *viewers = users.order_by('id').values_list('id', flat=True)
+            story_id = self.story_id = Story.objects.create(story_user_id=author, story_text=prefix).story_id
+            concurrency = kwargs['concurrency']
+            self.stdout.write(f'{len(viewers)} views of a new story, {concurrency} concurrent')
+
+            direct = self.run(lambda user_id: per_request_view(story_id, user_id), viewers, concurrency)
+            buffered = self.run(lambda user_id: story_views.record_view(user_id, story_id), viewers, concurrency,
+                                finish=story_views.flush)
+            self.stdout.write(f'per-request {direct:8.1f} views/s, buffered {buffered:8.1f} views/s, '
+                              f'{buffered / direct:5.2f}x')
+        finally:
+            # Their story and its views go with them.
+            users.delete()
+
+    def run(self, view, viewers, concurrency, finish=None):
+
+        def worker(user_id):
+            try:
+                view(user_id)
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, viewers))
+        if finish is not None:
+            finish()
+        elapsed = time.perf_counter() - started
+
+        written = Story.viewed_by.through.objects.filter(story_id=self.story_id).count()
+        if written != len(viewers):
+            raise CommandError(f'Expected {len(viewers)} views to be written, found {written}')
+        Story.viewed_by.through.objects.filter(story_id=self.story_id).delete()
+        return len(viewers) / elapsed
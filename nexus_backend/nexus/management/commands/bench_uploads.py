@@ -0,0 +1,60 @@
+import os
+import tempfile
+import tracemalloc
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand
+from nexus import media
+
+DEFAULT_SIZES = [1, 5, 10, 25, 50]
+
+
+def make_upload(size_mb):
+    # Large request bodies reach handlers as temporary files, see FILE_UPLOAD_MAX_MEMORY_SIZE.
+    upload = TemporaryUploadedFile('bench.jpg', 'image/jpeg', size_mb * 1024 * 1024, None)
+    upload.write(b'\xff\xd8\xff\xe0')
+    remaining = upload.size - 4
+    while remaining > 0:
+        block = min(remaining, 1024 * 1024)
+        upload.write(os.urandom(block))
+        remaining -= block
+    upload.seek(0)
+    return upload
+
+
+def peak_bytes(save):
+    tracemalloc.start()
+    try:
+        save()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class Command(BaseCommand):
+    help = 'Reports peak Python memory per upload for buffered and streamed saves'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, action='append', dest='sizes',
+                            help=f'Upload size in MB, repeatable (default: {", ".join(map(str, DEFAULT_SIZES))})')
+
+    def handle(self, *args, **kwargs):
+
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemStorage(location=location)
+            for size_mb in kwargs['sizes'] or DEFAULT_SIZES:
+                upload = make_upload(size_mb)
+                try:
+                    buffered = peak_bytes(lambda: storage.save('buffered.jpg', ContentFile(upload.read())))
+                    upload.seek(0)
+                    with mock.patch.object(media, 'default_storage', storage), \
+                            mock.patch.object(media, 'MEDIA_UPLOAD_MAX_BYTES', upload.size):
+                        streamed = peak_bytes(lambda: media.save_upload(upload, 'streamed.jpg'))
+                finally:
+                    upload.close()
+                for name in storage.listdir('')[1]:
+                    storage.delete(name)
+                self.stdout.write(f'{size_mb:>4} MB  buffered peak {buffered / 1024:10.0f} KB, '
+                                  f'streamed peak {streamed / 1024:8.0f} KB')
@@ -0,0 +1,41 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from nexus import retention
+
+class Command(BaseCommand):
+    help = 'Deletes notifications beyond the retention policy in bounded batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=retention.NOTIFICATION_RETENTION_DAYS,
+                            help='Delete notifications older than this many days')
+        parser.add_argument('--keep', type=int, default=retention.NOTIFICATION_RETENTION_PER_USER,
+                            help='Keep at most this many notifications per user')
+        parser.add_argument('--batch-size', type=int, default=retention.NOTIFICATION_RETENTION_BATCH)
+        parser.add_argument('--after-user', type=int, default=0,
+                            help='Resume trimming inboxes after this user id')
+
+    def handle(self, *args, **kwargs):
+
+        batch_size = kwargs['batch_size']
+        started = time.perf_counter()
+        removed = 0
+
+        if kwargs['days'] is not None:
+            cutoff = timezone.now() - timezone.timedelta(days=kwargs['days'])
+            expired = retention.expire_notifications(cutoff, batch_size)
+            self.stdout.write(f'{expired} notifications older than {kwargs["days"]} days deleted.')
+            removed += expired
+
+        if kwargs['keep'] is not None:
+            last_user, trimmed = kwargs['after_user'], 0
+            try:
+                for last_user, count in retention.cap_inboxes(kwargs['keep'], batch_size, kwargs['after_user']):
+                    trimmed += count
+            except KeyboardInterrupt:
+                self.stdout.write(f'Interrupted; resume with --after-user {last_user}')
+            self.stdout.write(f'{trimmed} notifications beyond {kwargs["keep"]} per user deleted.')
+            removed += trimmed
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'{removed} notifications deleted in {elapsed:.2f}s ({removed / elapsed:.0f} rows/s).')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from nexus import authentication
+
+class Command(BaseCommand):
+    help = 'Deletes expired outstanding and blacklisted tokens'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **kwargs):
+
+        removed = authentication.compact_tokens(kwargs['batch_size'])
+        self.stdout.write(f'{removed} expired tokens deleted.')
@@ -1,19 +1,29 @@
+import time
 from django.core.management.base import BaseCommand
-from django.utils.timezone import now
-from nexus.models import Story
+from nexus import expiry
 
 class Command(BaseCommand):
     help = 'Deletes stories that have expired'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=expiry.STORY_EXPIRY_BATCH)
+        parser.add_argument('--workers', type=int, default=expiry.STORY_MEDIA_DELETE_WORKERS,
+                            help='Threads deleting media files')
+        parser.add_argument('--after-id', type=int, default=0, help='Resume after this story id')
+
     def handle(self, *args, **kwargs):
-        
-        expired_stories = Story.objects.filter(
-            expires_at__lte=now())
-        count = expired_stories.count()
 
-        for story in expired_stories:
-            if story.story_image: 
-                story.story_image.delete(save=False)
+        started = time.perf_counter()
+        last_id = kwargs['after_id']
+
+        def progress(story_id):
+            nonlocal last_id
+            last_id = story_id
+
+        try:
+            count = expiry.expire_stories(kwargs['batch_size'], kwargs['workers'], last_id, progress)
+        except KeyboardInterrupt:
+            self.stdout.write(f'Interrupted; resume with --after-id {last_id}')
+            return
 
-        expired_stories.delete()
-        self.stdout.write(f'{count} expired stories deleted.')
+        self.stdout.write(f'{count} expired stories deleted in {time.perf_counter() - started:.2f}s.')
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from nexus import feed_cache
+
+class Command(BaseCommand):
+    help = 'Reports home feed cache hits, misses and hit rate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after reporting')
+
+    def handle(self, *args, **kwargs):
+
+        stats = feed_cache.stats()
+        self.stdout.write(
+            f'{stats["hits"]} hits, {stats["misses"]} misses, '
+            f'{stats["hit_rate"]:.1%} hit rate.')
+
+        if kwargs['reset']:
+            feed_cache.reset_stats()
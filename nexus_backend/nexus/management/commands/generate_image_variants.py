@@ -0,0 +1,58 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from nexus import images
+
+
+def render(name):
+    # Runs in a worker process: storage only, the parent records the result.
+    try:
+        return name, images.generate_variants(name), None
+    except Exception as e:
+        return name, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Generates image variants for uploaded media that has none yet, using a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', dest='kinds', choices=sorted(images.SOURCES),
+                            help='Only process this kind of media, repeatable (default: all)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--batch-size', type=int, default=200)
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate existing variants too, e.g. after changing MEDIA_VARIANT_FORMATS')
+
+    def handle(self, *args, **kwargs):
+
+        started = time.perf_counter()
+        generated = failed = 0
+        # Worker processes must not inherit open database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=kwargs['workers'], initializer=django.setup) as pool:
+            for kind in kwargs['kinds'] or sorted(images.SOURCES):
+                model, field = images.SOURCES[kind]
+                pending = (model.objects.exclude(**{field: ''})
+                           .exclude(**{f'{field}__isnull': True}).order_by('pk'))
+                if not kwargs['all']:
+                    pending = pending.filter(image_variants={})
+                last_pk = 0
+                while True:
+                    batch = list(pending.filter(pk__gt=last_pk).values_list('pk', field)[:kwargs['batch_size']])
+                    if not batch:
+                        break
+                    last_pk = batch[-1][0]
+                    results = pool.map(render, [name for _, name in batch])
+                    for (pk, _), (name, variants, error) in zip(batch, results):
+                        if error is not None:
+                            failed += 1
+                            self.stderr.write(f'{kind} {pk} ({name}): {error}')
+                            continue
+                        images.record_variants(kind, pk, name, variants)
+                        generated += 1
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f'Variants generated for {generated} images in {elapsed:.1f}s, {failed} failed.')
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.db.models import BigIntegerField, Count, F, Sum
+from nexus import images, media
+from nexus.models import MediaBlob
+
+
+def megabytes(size):
+    return f'{(size or 0) / (1024 * 1024):.1f} MB'
+
+
+class Command(BaseCommand):
+    help = 'Reports the storage saved by content-addressed media and checks blob reference counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10, help='List this many of the most shared blobs')
+        parser.add_argument('--repair', action='store_true',
+                            help='Reset reference counts that disagree with the rows, then delete unreferenced blobs')
+
+    def handle(self, *args, **kwargs):
+
+        totals = MediaBlob.objects.aggregate(
+            blobs=Count('pk'), stored=Sum('size'), references=Sum('ref_count'),
+            referenced=Sum(F('size') * F('ref_count'), output_field=BigIntegerField()))
+        stored, referenced = totals['stored'] or 0, totals['referenced'] or 0
+        saved = referenced - stored
+        self.stdout.write(f'{totals["blobs"]} blobs for {totals["references"] or 0} uploads: '
+                          f'{megabytes(stored)} stored instead of {megabytes(referenced)}, '
+                          f'{megabytes(saved)} saved ({100 * saved / referenced if referenced else 0:.1f}%).')
+
+        for kind, (model, field) in sorted(images.SOURCES.items()):
+            legacy = (model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                      .exclude(**{f'{field}__startswith': f'{media.BLOB_PREFIX}/'}).count())
+            if legacy:
+                self.stdout.write(f'{legacy} {kind} images predate blobs and are stored once per row.')
+
+        shared = MediaBlob.objects.filter(ref_count__gt=1).order_by('-ref_count')[:kwargs['top']]
+        for blob in shared:
+            self.stdout.write(f'{blob.ref_count:>6} x {blob.name} saves {megabytes(blob.size * (blob.ref_count - 1))}')
+
+        actual = media.count_references()
+        drifted = [(name, ref_count, actual.get(name, 0))
+                   for name, ref_count in MediaBlob.objects.values_list('name', 'ref_count')
+                   if ref_count != actual.get(name, 0)]
+        for name, recorded, counted in drifted:
+            self.stdout.write(f'{name}: {recorded} references recorded, {counted} rows')
+        if drifted and kwargs['repair']:
+            for name, _, counted in drifted:
+                MediaBlob.objects.filter(name=name).update(ref_count=counted)
+            deleted = media.collect_blobs()
+            self.stdout.write(f'{len(drifted)} reference counts repaired, {deleted} unreferenced blobs deleted.')
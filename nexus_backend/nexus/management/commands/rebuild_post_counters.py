@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from nexus.models import Post
+from nexus.counters import drifted_posts, rebuild_counters
+
+class Command(BaseCommand):
+    help = 'Recomputes Post.like_count and Post.comment_count from likes and comments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help='Only report posts whose counters have drifted')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **kwargs):
+
+        if kwargs['verify']:
+            drifted = drifted_posts().count()
+            self.stdout.write(f'{drifted} posts have drifted counters.')
+            return
+
+        batch_size = kwargs['batch_size']
+        last_id = Post.objects.aggregate(last=Max('post_id'))['last'] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            updated += rebuild_counters(
+                Post.objects.filter(post_id__gte=start, post_id__lt=start + batch_size))
+
+        self.stdout.write(f'{updated} post counters rebuilt.')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from nexus.models import UserProfile
+from nexus import timeline
+
+class Command(BaseCommand):
+    help = 'Rebuilds every materialized home timeline from the follow graph'
+
+    def handle(self, *args, **kwargs):
+
+        count = 0
+        for user_profile in UserProfile.objects.select_related('user').iterator():
+            timeline.rebuild(user_profile)
+            count += 1
+
+        self.stdout.write(f'{count} timelines rebuilt.')
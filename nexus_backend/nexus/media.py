@@ -0,0 +1,267 @@
+import hashlib
+import logging
+import os
+from collections import Counter
+from functools import partial
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Count, F
+from . import images
+from .executor import run_blocking
+from .metadata import metadata_free_pieces
+from .models import MediaBlob
+
+logger = logging.getLogger(__name__)
+
+MEDIA_UPLOAD_MAX_BYTES = getattr(settings, 'MEDIA_UPLOAD_MAX_BYTES', 50 * 1024 * 1024)
+MEDIA_UPLOAD_CHUNK_SIZE = getattr(settings, 'MEDIA_UPLOAD_CHUNK_SIZE', 64 * 1024)
+
+# Leading bytes of every accepted format, mapped to its content type.
+SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+EXTENSIONS = {'image/jpeg': 'jpg', 'image/png': 'png', 'image/gif': 'gif', 'image/webp': 'webp'}
+
+# Content-addressed uploads live under this directory, see store_upload.
+BLOB_PREFIX = 'blobs'
+
+
+class UploadRejected(ValueError):
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff(head):
+    """Content type of a file from its first bytes, or None if it is not an accepted image."""
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def check_upload(upload):
+    """Rejects an upload that is too large or not an image, reading only its first bytes.
+
+    Returns the sniffed content type.
+    """
+    if upload.size is not None and upload.size > MEDIA_UPLOAD_MAX_BYTES:
+        raise UploadRejected(f"Files may be at most {MEDIA_UPLOAD_MAX_BYTES // (1024 * 1024)} MB", 413)
+    upload.seek(0)
+    head = upload.read(16)
+    upload.seek(0)
+    content_type = sniff(head)
+    if content_type is None:
+        raise UploadRejected("Only JPEG, PNG, GIF and WebP images are accepted", 415)
+    return content_type
+
+
+class _LimitedFile(File):
+    """Hands the upload to storage chunk by chunk, enforcing the size limit as it goes.
+
+    With pieces, only those parts of the file are handed over, see
+    metadata.metadata_free_pieces.
+    """
+
+    def __init__(self, file, name=None, pieces=None):
+        super().__init__(file, name)
+        self.pieces = pieces
+
+    def _raw_chunks(self, chunk_size):
+        if self.pieces is None:
+            yield from super().chunks(chunk_size)
+            return
+        for piece in self.pieces:
+            if isinstance(piece, bytes):
+                yield piece
+                continue
+            offset, length = piece
+            self.file.seek(offset)
+            while length > 0:
+                data = self.file.read(min(chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    def chunks(self, chunk_size=None):
+        received = 0
+        for chunk in self._raw_chunks(chunk_size or MEDIA_UPLOAD_CHUNK_SIZE):
+            received += len(chunk)
+            if received > MEDIA_UPLOAD_MAX_BYTES:
+                raise UploadRejected(f"Files may be at most {MEDIA_UPLOAD_MAX_BYTES // (1024 * 1024)} MB", 413)
+            yield chunk
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+
+def save_upload(upload, name, pieces=None):
+    """Streams a checked upload to default_storage under name and returns the stored name.
+
+    Uploads arrive in memory or in a temporary file, and are copied in
+    MEDIA_UPLOAD_CHUNK_SIZE pieces so the whole file is never held as one
+    bytes object. A partially written file is removed if the copy fails.
+    """
+    name = default_storage.get_available_name(name)
+    upload.seek(0)
+    try:
+        return default_storage.save(name, _LimitedFile(upload, name, pieces))
+    except Exception:
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        raise
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(f'{BLOB_PREFIX}/')
+
+
+def digest_upload(upload):
+    """Hashes a checked upload chunk by chunk, without its metadata.
+
+    Returns the blob name, the size and the pieces to store (see
+    metadata.metadata_free_pieces). The name is derived from the SHA-256 of
+    the stored bytes alone, so identical images map to the same blob however
+    they were named by the client, and even if their EXIF differed.
+    """
+    content_type = check_upload(upload)
+    pieces = metadata_free_pieces(upload, upload.size, content_type)
+    hasher = hashlib.sha256()
+    size = 0
+    for chunk in _LimitedFile(upload, pieces=pieces).chunks():
+        hasher.update(chunk)
+        size += len(chunk)
+    upload.seek(0)
+    digest = hasher.hexdigest()
+    return f'{BLOB_PREFIX}/{digest[:2]}/{digest}.{EXTENSIONS[content_type]}', size, pieces
+
+
+def claim_blob(name, size):
+    """Takes a reference to the blob stored under name, creating its row on first use."""
+    digest = os.path.basename(name).split('.')[0]
+    with transaction.atomic():
+        # The lock orders this against collect_blobs deleting a blob that just lost its last reference.
+        MediaBlob.objects.select_for_update().get_or_create(digest=digest, defaults={'name': name, 'size': size})
+        MediaBlob.objects.filter(pk=digest).update(ref_count=F('ref_count') + 1)
+
+
+def write_blob(upload, name, pieces=None):
+    """Streams the upload to storage unless an earlier upload of the same bytes is already there."""
+    if default_storage.exists(name):
+        return
+    stored = save_upload(upload, name, pieces)
+    if stored != name:
+        # A concurrent upload of the same bytes won the name; its file is identical.
+        default_storage.delete(stored)
+
+
+def store_upload(upload):
+    """Stores an upload content-addressed and returns the blob name to keep on the row.
+
+    Metadata is stripped on the way, so originals are as safe to publish as
+    their variants. A duplicate upload only adds a reference: nothing is
+    written to storage. Every call must be paired with a release of the
+    returned name.
+    """
+    name, size, pieces = digest_upload(upload)
+    claim_blob(name, size)
+    try:
+        write_blob(upload, name, pieces)
+    except Exception:
+        release(name)
+        raise
+    return name
+
+
+async def astore_upload(upload):
+    """Async store_upload: hashing and file writes run off the event loop, the bookkeeping in the ORM."""
+    name, size, pieces = await run_blocking(digest_upload, upload)
+    await sync_to_async(claim_blob)(name, size)
+    try:
+        await run_blocking(write_blob, upload, name, pieces)
+    except Exception:
+        await sync_to_async(release)(name)
+        raise
+    return name
+
+
+def delete_blob_files(name):
+    """Deletes a blob and every variant rendered from it; False if storage refused."""
+    try:
+        default_storage.delete(name)
+        images.delete_variants_of(name)
+        return True
+    except Exception:
+        logger.exception("Could not delete media blob %s", name)
+        return False
+
+
+def collect_blobs(names=None, pool=None):
+    """Deletes blobs that are no longer referenced, or only those among names.
+
+    Files go first and rows after, so a blob whose file could not be deleted
+    stays behind with no references and is retried by the next collection.
+    Files are deleted through pool when one is given. Returns the number of
+    blobs deleted.
+    """
+    with transaction.atomic():
+        unreferenced = MediaBlob.objects.select_for_update(skip_locked=True).filter(ref_count__lte=0)
+        if names is not None:
+            unreferenced = unreferenced.filter(name__in=names)
+        unreferenced = list(unreferenced.values_list('name', flat=True))
+        results = (pool.map if pool is not None else map)(delete_blob_files, unreferenced)
+        deleted = [name for name, ok in zip(unreferenced, results) if ok]
+        MediaBlob.objects.filter(name__in=deleted).delete()
+    return len(deleted)
+
+
+def release(*names, pool=None):
+    """Drops one reference per blob name given and deletes blobs left without any.
+
+    Called inside the transaction that deletes or repoints the rows naming
+    them, the references are dropped with the rows, and files are deleted
+    only once it commits; a rollback leaves both in place.
+    """
+    counts = Counter(name for name in names if is_blob(name))
+    if not counts:
+        return
+    with transaction.atomic():
+        for name, count in counts.items():
+            MediaBlob.objects.filter(name=name).update(ref_count=F('ref_count') - count)
+    transaction.on_commit(partial(collect_blobs, list(counts), pool))
+
+
+def count_references():
+    """{blob name: rows naming it}, counted from the rows themselves rather than ref_count."""
+    references = Counter()
+    for model, field in images.SOURCES.values():
+        rows = (model.objects.filter(**{f'{field}__startswith': f'{BLOB_PREFIX}/'})
+                .order_by().values(field).annotate(rows=Count('pk')).values_list(field, 'rows'))
+        references.update(dict(rows))
+    return references
+
+
+def _delete_file(name, variants):
+    default_storage.delete(name)
+    images.delete_variants(variants)
+
+
+def discard(name, variants=None):
+    """Lets go of a row's image: a blob reference, or the file itself for uploads stored before blobs.
+
+    Like release, nothing is deleted from storage before the current transaction commits.
+    """
+    if is_blob(name):
+        release(name)
+    elif name:
+        transaction.on_commit(partial(_delete_file, name, variants))
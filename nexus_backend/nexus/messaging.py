@@ -1,89 +1,181 @@
 import os
 from django.conf import settings
 from ninja import NinjaAPI, Schema
-from ninja.responses import Response
+from .renderers import FastJSONParser, FastJSONRenderer, Response
 from rest_framework.permissions import IsAuthenticated
-from .models import Post, UserProfile, Conversation, Message, User
-from ninja_jwt.authentication import JWTAuth
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Substr
+from .models import Post, UserProfile, Conversation, Message, ReadMarker, User
+from .authentication import AsyncCachedJWTAuth, CachedJWTAuth
 from .schema import PostSchema
 from django.utils.timesince import timesince
 from django.utils import timezone
-from .schema import ConversationMessagesSchema, NewMessageSchema
+from .schema import ConversationMessagesSchema, MarkReadSchema, NewMessageSchema
+from .avatars import aavatar_urls, avatar_urls
+from .chat_socket import publish_after_commit
+from .pagination import clamp_limit, decode_cursor, encode_cursor, keyset_after, keyset_before
 
-message_router = NinjaAPI(urls_namespace='message_api')
+message_router = NinjaAPI(urls_namespace='message_api', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
+CHAT_PAGE_SIZE = 50
+CHAT_MAX_PAGE_SIZE = 200
+PREVIEW_SNIPPET_LENGTH = 80
 
-@message_router.get("/chats-preview", auth=JWTAuth())
-def get_homepage_posts(request) -> Response:
+
+@message_router.get("/chats-preview", auth=AsyncCachedJWTAuth())
+async def get_homepage_posts(request, before: str = None, limit: int = None) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
+    limit = clamp_limit(limit)
+
+    conversations = chat_previews(request.user)
+    if before:
+        try:
+            conversations = conversations.filter(keyset_before('last_activity_at', 'id', *decode_cursor(before)))
+        except ValueError:
+            return Response({"error": "Invalid cursor"}, status=400)
+
     try:
-        conversations = Conversation.objects.filter(users=request.user)
-
-        chat_previews = []
-
-        for conversation in conversations:
-            other_users = conversation.users.exclude(id=request.user.id)
-            conversation_with = other_users.first()
-            other_user_profile = UserProfile.objects.get(
-                user=conversation_with)
-            profile_picture_url = (
-                other_user_profile.profile_image.url if other_user_profile.profile_image else f"{
-                    settings.MEDIA_URL}profile_images/default.png"
-            )
-            chat_previews.append({
+        # One extra row tells us whether another page exists.
+        page = [conversation async for conversation in conversations[:limit + 1]]
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1].last_activity_at, page[-1].id)
+
+        members = {}
+        async for membership in Conversation.users.through.objects.filter(
+                conversation__in=page).exclude(user=request.user).select_related('user').order_by('user_id'):
+            members.setdefault(membership.conversation_id, membership.user)
+        avatars = await aavatar_urls(conversation_with.id for conversation_with in members.values())
+
+        chat_previews_data = []
+        for conversation in page:
+            conversation_with = members.get(conversation.id)
+            if conversation_with is None:
+                continue
+            last_message = None
+            if conversation.last_message_id:
+                last_message = {
+                    "content": conversation.snippet,
+                    "created_at": conversation.last_message_at.isoformat(),
+                    "is_owner": conversation.last_message_producer_id == request.user.id,
+                }
+            chat_previews_data.append({
                 "id": conversation.id,
                 "username": conversation_with.username,
-                "profile_picture": profile_picture_url
+                "profile_picture": avatars[conversation_with.id],
+                "last_message": last_message,
+                "unread_count": conversation.unread_count,
             })
-        return Response(chat_previews, status=200)
+        return Response({"chats": chat_previews_data, "next_cursor": next_cursor}, status=200)
 
     except Exception as e:
         return Response({"error": str(e)}, status=400)
 
 
-@message_router.post("/chat-messages", auth=JWTAuth())
+def chat_previews(viewer):
+    """The viewer's conversations, most recently active first, annotated with
+    the last message and the viewer's unread count so that a page of previews
+    is a single query."""
+    last_read = ReadMarker.objects.filter(
+        conversation=OuterRef('pk'), user=viewer).values('last_read_message_id')[:1]
+    unread = (
+        Message.objects
+        .filter(belongs_in=OuterRef('pk'), id__gt=OuterRef('last_read_id'))
+        .exclude(producer=viewer)
+        .order_by()
+        .values('belongs_in')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    return (
+        Conversation.objects
+        .filter(users=viewer)
+        .annotate(
+            last_read_id=Coalesce(Subquery(last_read), 0),
+            snippet=Substr('last_message__content', 1, PREVIEW_SNIPPET_LENGTH),
+            last_message_at=F('last_message__created_at'),
+            last_message_producer_id=F('last_message__producer_id'),
+        )
+        .annotate(unread_count=Coalesce(Subquery(unread), 0))
+        .order_by('-last_activity_at', '-id')
+    )
+
+
+def pair_key(user_id, other_user_id):
+    low, high = sorted((user_id, other_user_id))
+    return f"{low}:{high}"
+
+
+def direct_conversation(user, other_user):
+    """The conversation between two users, created on first use.
+
+    The unique pair_key makes this one indexed lookup, and concurrent
+    callers converge on the same row: get_or_create retries the lookup
+    when its insert loses the race. The row and its members are committed
+    together, so a conversation is never visible without its users.
+    """
+    with transaction.atomic():
+        conversation, created = Conversation.objects.get_or_create(pair_key=pair_key(user.id, other_user.id))
+        if created:
+            conversation.users.add(user, other_user)
+    return conversation
+
+
+def mark_read(convo_id, user_id, message_id):
+    """Moves the user's read marker up to message_id; it never moves back."""
+    ReadMarker.objects.bulk_create(
+        [ReadMarker(conversation_id=convo_id, user_id=user_id)], ignore_conflicts=True)
+    ReadMarker.objects.filter(
+        conversation_id=convo_id, user_id=user_id, last_read_message_id__lt=message_id,
+    ).update(last_read_message_id=message_id)
+
+
+@message_router.post("/chat-messages", auth=CachedJWTAuth())
 def get_chat_messages(request, payload: ConversationMessagesSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
     try:
 
-        conversation = Conversation.objects.get(id=payload.convo_id)
+        conversation = Conversation.objects.get(id=payload.convo_id, users=request.user)
 
         other_user = conversation.users.exclude(id=request.user.id)
         conversation_with = other_user.first()
-        other_user_profile = UserProfile.objects.get(user=conversation_with)
-
-        user_profile = UserProfile.objects.get(user=request.user)
 
-        sender_profile_picture = (
-            user_profile.profile_image.url if user_profile.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
-        )
+        avatars = avatar_urls([request.user.id, conversation_with.id])
+        sender_profile_picture = avatars[request.user.id]
+        receiver_profile_picture = avatars[conversation_with.id]
 
-        receiver_profile_picture = (
-            other_user_profile.profile_image.url if other_user_profile.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
-        )
+        if payload.before_id is not None and payload.after_id is not None:
+            return Response({"error": "Pass either before_id or after_id, not both"}, status=400)
 
-        chat_messages = Message.objects.filter(
-            belongs_in=payload.convo_id).order_by("created_at")
+        limit = clamp_limit(payload.limit, CHAT_PAGE_SIZE, CHAT_MAX_PAGE_SIZE)
+        rows, has_more = history_page(conversation.id, payload.before_id, payload.after_id, limit)
+        if rows is None:
+            return Response({"error": "Message not found"}, status=404)
+        if rows and payload.before_id is None:
+            mark_read(conversation.id, request.user.id, rows[-1]["id"])
 
         messages = []
 
-        for message in chat_messages:
+        for row in rows:
             messages.append({
-                "content": message.content,
-                "is_owner": True if message.producer == request.user else False
+                "id": row["id"],
+                "content": row["content"],
+                "is_owner": row["producer_id"] == request.user.id,
+                "created_at": row["created_at"].isoformat(),
             })
 
         response_object = {
             "sender_profile_picture": sender_profile_picture,
             "receiver_profile_picture": receiver_profile_picture,
             "username": conversation_with.username,
-            "messages": messages
+            "messages": messages,
+            "has_more": has_more
         }
 
         return Response(response_object, status=200)
@@ -92,23 +184,77 @@ def get_chat_messages(request, payload: ConversationMessagesSchema) -> Response:
         return Response({"error": str(e)}, status=400)
 
 
-@message_router.post("/add-message", auth=JWTAuth())
+def history_page(convo_id, before_id, after_id, limit):
+    """Up to limit messages of a conversation, oldest first, plus whether more exist.
+
+    By default the newest messages are returned; before_id scrolls back from
+    a message the client holds and after_id returns only newer ones. Rows are
+    walked along message_history_idx and read as dicts. Returns (None, False)
+    if the cursor message is not in the conversation.
+    """
+    history = Message.objects.filter(belongs_in=convo_id).values('id', 'content', 'producer_id', 'created_at')
+
+    cursor_id = after_id if after_id is not None else before_id
+    if cursor_id is not None:
+        moment = Message.objects.filter(
+            id=cursor_id, belongs_in=convo_id).values_list('created_at', flat=True).first()
+        if moment is None:
+            return None, False
+
+    if after_id is not None:
+        history = history.filter(keyset_after('created_at', 'id', moment, after_id)).order_by('created_at', 'id')
+    else:
+        if before_id is not None:
+            history = history.filter(keyset_before('created_at', 'id', moment, before_id))
+        history = history.order_by('-created_at', '-id')
+
+    # One extra row tells us whether another page exists.
+    rows = list(history[:limit + 1].iterator())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_id is None:
+        rows.reverse()
+    return rows, has_more
+
+
+@message_router.post("/add-message", auth=CachedJWTAuth())
 def get_chat_messages(request, payload: NewMessageSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
     try:
         receiver_profile = User.objects.get(username=payload.receiver_username)
-        conversation = Conversation.objects.get(id=payload.convo_id)
-        Message.objects.create(
+        conversation = Conversation.objects.filter(
+            id=payload.convo_id, pair_key=pair_key(request.user.id, receiver_profile.id)).first()
+        if conversation is None:
+            return Response({"error": "You are not a participant of this conversation"}, status=403)
+        message = Message.objects.create(
             belongs_in=conversation,
             producer=request.user,
             consumer=receiver_profile,
             content=payload.content,
             created_at=timezone.now()
         )
-
-        return Response({"message": "Message created successfully"}, status=200)
+        Conversation.objects.filter(
+            id=conversation.id, last_activity_at__lte=message.created_at,
+        ).update(last_message=message, last_activity_at=message.created_at)
+        mark_read(conversation.id, request.user.id, message.id)
 
     except Exception as e:
         return Response({"error": str(e)}, status=400)
+
+    publish_after_commit(message)
+    return Response({"message": "Message created successfully"}, status=200)
+
+
+@message_router.post("/mark-read", auth=CachedJWTAuth())
+def mark_conversation_read(request, payload: MarkReadSchema) -> Response:
+    if not request.user.is_authenticated:
+        return Response({"error": "Unauthorized"}, status=401)
+
+    if not Message.objects.filter(
+            id=payload.message_id, belongs_in=payload.convo_id, belongs_in__users=request.user).exists():
+        return Response({"error": "Message not found"}, status=404)
+
+    mark_read(payload.convo_id, request.user.id, payload.message_id)
+    return Response({"success": True}, status=200)
@@ -0,0 +1,150 @@
+"""Lossless metadata stripping for uploaded originals.
+
+Photos carry EXIF (location, camera, timestamps), XMP and text chunks that
+must not be published. Instead of decoding and re-encoding, which would
+cost the request a full decode and degrade JPEGs, the container is walked
+by its segment headers and only the metadata segments are left out. The
+result is a list of pieces: (offset, length) ranges of the original file
+to copy, and bytes to insert in their place, which media streams in
+chunks like any other upload.
+
+Anything after a structure that cannot be parsed is kept as it is;
+deciding whether the pixels are valid is left to the decoders.
+"""
+import struct
+from PIL import Image
+
+# JPEG markers kept before the first scan: JFIF (APP0), ICC profiles (APP2)
+# and Adobe's colour transform (APP14) change how pixels decode; the other
+# application segments and comments are metadata.
+JPEG_KEPT_APP_MARKERS = {0xE0, 0xE2, 0xEE}
+PNG_METADATA_CHUNKS = {b'eXIf', b'tEXt', b'zTXt', b'iTXt', b'tIME'}
+WEBP_METADATA_CHUNKS = {b'EXIF', b'XMP '}
+WEBP_EXIF_FLAG, WEBP_XMP_FLAG = 0x08, 0x04
+EXIF_ORIENTATION = 0x0112
+
+
+class _Pieces(list):
+
+    def keep(self, start, length):
+        if length <= 0:
+            return
+        if self and isinstance(self[-1], tuple) and sum(self[-1]) == start:
+            self[-1] = (self[-1][0], self[-1][1] + length)
+        else:
+            self.append((start, length))
+
+    def insert_bytes(self, data):
+        self.append(data)
+
+
+def _read_at(file, offset, length):
+    file.seek(offset)
+    return file.read(length)
+
+
+def _jpeg_orientation_segment(payload):
+    """An APP1 segment holding only the orientation of the EXIF payload, or None if upright."""
+    if not payload.startswith(b'Exif\x00\x00'):
+        return None
+    try:
+        exif = Image.Exif()
+        exif.load(payload)
+        orientation = exif.get(EXIF_ORIENTATION, 1)
+    except Exception:
+        return None
+    if orientation in (None, 1):
+        return None
+    kept = Image.Exif()
+    kept[EXIF_ORIENTATION] = orientation
+    data = b'Exif\x00\x00' + kept.tobytes()
+    return b'\xff\xe1' + struct.pack('>H', len(data) + 2) + data
+
+
+def _jpeg(file, size, pieces):
+    offset = 2
+    pieces.keep(0, 2)
+    while offset + 4 <= size:
+        marker = _read_at(file, offset, 4)
+        if marker[0] != 0xFF:
+            break
+        kind = marker[1]
+        if kind == 0xDA:
+            # Start of scan: entropy-coded data follows, and with it the pixels.
+            break
+        length = struct.unpack('>H', marker[2:4])[0]
+        if length < 2 or offset + 2 + length > size:
+            break
+        if 0xE0 <= kind <= 0xEF and kind not in JPEG_KEPT_APP_MARKERS or kind == 0xFE:
+            if kind == 0xE1:
+                # Browsers still honour the orientation of the original, so it survives alone.
+                segment = _jpeg_orientation_segment(_read_at(file, offset + 4, length - 2))
+                if segment is not None:
+                    pieces.insert_bytes(segment)
+        else:
+            pieces.keep(offset, 2 + length)
+        offset += 2 + length
+    pieces.keep(offset, size - offset)
+
+
+def _png(file, size, pieces):
+    offset = 8
+    pieces.keep(0, 8)
+    while offset + 12 <= size:
+        length, kind = struct.unpack('>I4s', _read_at(file, offset, 8))
+        end = offset + 12 + length
+        if end > size:
+            break
+        if kind not in PNG_METADATA_CHUNKS:
+            pieces.keep(offset, end - offset)
+        offset = end
+        if kind == b'IEND':
+            break
+    pieces.keep(offset, size - offset)
+
+
+def _webp(file, size, pieces):
+    offset = 12
+    kept = []
+    while offset + 8 <= size:
+        kind, length = struct.unpack('<4sI', _read_at(file, offset, 8))
+        end = offset + 8 + length + (length & 1)
+        if end > size:
+            break
+        if kind == b'VP8X':
+            header = bytearray(_read_at(file, offset, 8 + length))
+            header[8] &= ~(WEBP_EXIF_FLAG | WEBP_XMP_FLAG) & 0xFF
+            kept.append(bytes(header))
+        elif kind not in WEBP_METADATA_CHUNKS:
+            kept.append((offset, end - offset))
+        offset = end
+    kept.append((offset, size - offset))
+    # The RIFF header carries the size of everything after it, which has just changed.
+    body = sum(len(piece) if isinstance(piece, bytes) else piece[1] for piece in kept)
+    pieces.insert_bytes(b'RIFF' + struct.pack('<I', body + 4) + b'WEBP')
+    for piece in kept:
+        if isinstance(piece, bytes):
+            pieces.insert_bytes(piece)
+        else:
+            pieces.keep(*piece)
+
+
+SCANNERS = {
+    'image/jpeg': _jpeg,
+    'image/png': _png,
+    'image/webp': _webp,
+}
+
+
+def metadata_free_pieces(file, size, content_type):
+    """The pieces making up file without its metadata, or None when the format carries none we strip.
+
+    GIFs have no EXIF; their comment extensions are left alone.
+    """
+    scanner = SCANNERS.get(content_type)
+    if scanner is None:
+        return None
+    pieces = _Pieces()
+    scanner(file, size, pieces)
+    file.seek(0)
+    return pieces
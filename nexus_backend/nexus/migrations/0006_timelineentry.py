@@ -0,0 +1,59 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def backfill_timelines(apps, schema_editor):
+    UserProfile = apps.get_model('nexus', 'UserProfile')
+    Post = apps.get_model('nexus', 'Post')
+    TimelineEntry = apps.get_model('nexus', 'TimelineEntry')
+    max_length = getattr(settings, 'TIMELINE_MAX_LENGTH', 800)
+    follower_limit = getattr(settings, 'TIMELINE_FANOUT_FOLLOWER_LIMIT', 5000)
+
+    popular = UserProfile.objects.annotate(
+        follower_count=Count('followers')).filter(follower_count__gt=follower_limit)
+    UserProfile.objects.filter(pk__in=popular.values('pk')).update(fanout_on_read=True)
+
+    # Timelines carry the owner's own posts and those of followed authors who fan out on write.
+    for profile in UserProfile.objects.iterator():
+        posts = Post.objects.filter(
+            Q(user_id=profile.user_id)
+            | Q(user_id__in=profile.following.filter(userprofile__fanout_on_read=False).values('id'))
+        ).order_by('-post_date', '-post_id').values_list('post_id', 'post_date')[:max_length]
+        TimelineEntry.objects.bulk_create(
+            [TimelineEntry(owner_id=profile.user_id, post_id=post_id, post_date=post_date)
+             for post_id, post_date in posts],
+            batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0005_message'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('post_date', models.DateTimeField()),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to=settings.AUTH_USER_MODEL)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='nexus.post')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-post_date', '-post'], name='timeline_owner_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'post'), name='unique_timeline_entry')],
+            },
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='fanout_on_read',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:16
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_counters(apps, schema_editor):
+    Post = apps.get_model('nexus', 'Post')
+    Comment = apps.get_model('nexus', 'Comment')
+    likes = Post.likes_list.through.objects.filter(post_id=OuterRef('pk')).order_by(
+        ).values('post_id').annotate(n=Count('pk')).values('n')
+    comments = Comment.objects.filter(comment_post=OuterRef('pk')).order_by(
+        ).values('comment_post').annotate(n=Count('pk')).values('n')
+    Post.objects.update(
+        like_count=Coalesce(Subquery(likes), 0),
+        comment_count=Coalesce(Subquery(comments), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0006_timelineentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_activity_and_read_state(apps, schema_editor):
+    Conversation = apps.get_model('nexus', 'Conversation')
+    Message = apps.get_model('nexus', 'Message')
+    ReadMarker = apps.get_model('nexus', 'ReadMarker')
+
+    for conversation in Conversation.objects.iterator():
+        last_message = Message.objects.filter(
+            belongs_in=conversation).order_by('-created_at', '-id').first()
+        if last_message is None:
+            continue
+        Conversation.objects.filter(pk=conversation.pk).update(
+            last_message=last_message, last_activity_at=last_message.created_at)
+        # Existing history counts as read; only new messages show as unread.
+        ReadMarker.objects.bulk_create(
+            [ReadMarker(conversation=conversation, user_id=user_id,
+                        last_read_message_id=last_message.id)
+             for user_id in conversation.users.values_list('id', flat=True)],
+            ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0008_hot_path_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='nexus.message'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['belongs_in', 'id'], name='message_unread_idx'),
+        ),
+        migrations.AddField(
+            model_name='readmarker',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to='nexus.conversation'),
+        ),
+        migrations.AddField(
+            model_name='readmarker',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_markers', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='readmarker',
+            constraint=models.UniqueConstraint(fields=('conversation', 'user'), name='unique_read_marker'),
+        ),
+        migrations.RunPython(backfill_activity_and_read_state, migrations.RunPython.noop),
+    ]
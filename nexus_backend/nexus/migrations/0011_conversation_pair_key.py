@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+def backfill_pair_keys(apps, schema_editor):
+    Conversation = apps.get_model('nexus', 'Conversation')
+    seen = set()
+    # If a pair somehow has several conversations, the most active one keeps the key.
+    for conversation in Conversation.objects.order_by('-last_activity_at', '-id').iterator():
+        user_ids = sorted(conversation.users.values_list('id', flat=True))
+        if len(user_ids) != 2:
+            continue
+        pair_key = f"{user_ids[0]}:{user_ids[1]}"
+        if pair_key in seen:
+            continue
+        seen.add(pair_key)
+        Conversation.objects.filter(pk=conversation.pk).update(pair_key=pair_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0010_chat_previews'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='pair_key',
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def key_follow_requests(apps, schema_editor):
+    Notification = apps.get_model('nexus', 'Notification')
+    seen = set()
+    # Requests stored before they were keyed; the newest one per requester keeps the key.
+    requests = Notification.objects.filter(notify_type='follow_request', group_key__isnull=True)
+    for notification in requests.order_by('-notify_time', '-notification_id').iterator():
+        group = (notification.notify_to_id, f"follow_request:{notification.notify_from_id}")
+        if group in seen or Notification.objects.filter(notify_to=group[0], group_key=group[1]).exists():
+            Notification.objects.filter(pk=notification.pk).delete()
+            continue
+        seen.add(group)
+        Notification.objects.filter(pk=notification.pk).update(group_key=group[1])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0014_notification_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['notify_time'], name='notification_time_idx'),
+        ),
+        migrations.RunPython(key_follow_requests, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:50
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nexus', '0015_notification_retention'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='story',
+            name='story_user_expiry_idx',
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(fields=['story_user', 'story_id'], include=('expires_at',), name='story_user_reel_idx'),
+        ),
+    ]
@@ -20,10 +20,22 @@ class Post(models.Model):
         User, on_delete=models.CASCADE, related_name='posts')
     post_image = models.ImageField(
         upload_to=post_image_directory, blank=True, null=True)
+    # Resized copies of post_image by variant name, see images.generate_variants.
+    image_variants = models.JSONField(default=dict, blank=True)
     caption = models.TextField(max_length=255, blank=True)
     likes_list = models.ManyToManyField(
         User, related_name='liked_posts', blank=True)
     post_date = models.DateTimeField(auto_now_add=True)
+    # Denormalized from likes_list and comments; only ever changed with F() updates.
+    like_count = models.PositiveIntegerField(default=0)
+    comment_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Profile grid and the pull-merged part of the feed.
+            models.Index(fields=['user_id', '-post_date', '-post_id'],
+                         name='post_user_date_idx'),
+        ]
 
     def __str__(self):
         return f'{self.post_id}: {self.caption}'
@@ -38,6 +50,12 @@ class Comment(models.Model):
     comment_message = models.TextField()
     comment_date = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['comment_post', 'comment_date'],
+                         name='comment_post_date_idx'),
+        ]
+
     def __str__(self):
         return f'Comment by {self.comment_user.username} on {self.comment_post.caption}'
 
@@ -56,10 +74,51 @@ class Notification(models.Model):
     notify_post = models.ForeignKey(
         Post, on_delete=models.CASCADE, blank=True, null=True)
     notify_time = models.DateTimeField(auto_now_add=True)
+    # Events with the same key for the same recipient share one row, see
+    # notifications.notify. notify_from is then the latest actor.
+    group_key = models.CharField(max_length=100, null=True, blank=True)
+    actor_count = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['notify_to', 'group_key'], name='unique_notification_group'),
+        ]
+        indexes = [
+            models.Index(fields=['notify_to', '-notify_time', '-notification_id'],
+                         name='notification_inbox_idx'),
+            # Drives the age-based retention sweep, see retention.expire_notifications.
+            models.Index(fields=['notify_time'], name='notification_time_idx'),
+        ]
 
     def __str__(self):
         return f'Notification to {self.notify_to.username}'
 
+
+class NotificationActor(models.Model):
+    """Each distinct user counted in an aggregated notification."""
+    notification = models.ForeignKey(
+        Notification, on_delete=models.CASCADE, related_name='actors')
+    actor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['notification', 'actor'], name='unique_notification_actor'),
+        ]
+
+
+
+class PendingNotification(models.Model):
+    """An event waiting in the outbox to be turned into a Notification, see notifications.drain."""
+    notify_from = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    notify_to = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    notify_type = models.CharField(max_length=50)
+    notify_text = models.TextField(blank=True)
+    notify_post = models.ForeignKey(Post, on_delete=models.CASCADE, blank=True, null=True, related_name='+')
+    # When the event happened; decides its grouping window however late it is delivered.
+    created_at = models.DateTimeField(default=timezone.now)
+
 # UserProfile Model
 
 
@@ -70,6 +129,7 @@ class UserProfile(models.Model):
     last_name = models.CharField(max_length=50)
     profile_image = models.ImageField(
         upload_to='profile_images/', blank=True, null=True) 
+    image_variants = models.JSONField(default=dict, blank=True)
     bio = models.TextField(blank=True)
     pending_requests = models.ManyToManyField(
         User, related_name='friend_requests', blank=True)
@@ -79,6 +139,11 @@ class UserProfile(models.Model):
         User, related_name='followed_by', blank=True)
     following = models.ManyToManyField(
         User, related_name='following', blank=True)
+    # Set once the user has too many followers to fan their posts out on write.
+    fanout_on_read = models.BooleanField(default=False)
+    # Inbox rows added or bumped since the user last opened the inbox.
+    unread_notifications = models.PositiveIntegerField(default=0)
+    notifications_seen_at = models.DateTimeField(default=timezone.now)
 
     # Story Model
 
@@ -90,6 +155,7 @@ class Story(models.Model):
     story_text = models.TextField(blank=True)
     story_image = models.ImageField(
         upload_to='media/story', blank=True, null=True)
+    image_variants = models.JSONField(default=dict, blank=True)
     story_time = models.DateTimeField(auto_now_add=True)
     viewed_by = models.ManyToManyField(
         User, related_name='viewed_by', blank=True)
@@ -101,14 +167,50 @@ class Story(models.Model):
 
     expires_at = models.DateTimeField(default=default_expiration_time)
 
+    class Meta:
+        indexes = [
+            # Serves "this author's live stories" in reel order; expires_at is
+            # included so PostgreSQL checks expiry from the index alone.
+            models.Index(fields=['story_user', 'story_id'], include=['expires_at'],
+                         name='story_user_reel_idx'),
+            # Expiry sweeps.
+            models.Index(fields=['expires_at'], name='story_expiry_idx'),
+        ]
+
     def __str__(self):
         return f'{self.story_user.username} posted a story'
 
 
+class MediaBlob(models.Model):
+    """An uploaded file stored once under its SHA-256, shared by every row that uploaded the same bytes.
+
+    ref_count is the number of posts, stories and profiles whose image names
+    this blob; see media.store_upload and media.release.
+    """
+    digest = models.CharField(max_length=64, primary_key=True)
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Blobs whose files still have to be deleted; normally none.
+            models.Index(fields=['ref_count'], condition=models.Q(ref_count__lte=0),
+                         name='media_blob_unreferenced_idx'),
+        ]
+
+
 class Conversation(models.Model):
     id = models.AutoField(primary_key=True)
     users = models.ManyToManyField(
         User, related_name="involved_users", blank=True)
+    # "<lower user id>:<higher user id>" for direct chats, see messaging.pair_key.
+    pair_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Kept current by add-message so previews need no per-conversation lookups.
+    last_message = models.ForeignKey(
+        'Message', related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_activity_at = models.DateTimeField(default=timezone.now)
 
 
 class Message(models.Model):
@@ -121,3 +223,45 @@ class Message(models.Model):
     belongs_in = models.ForeignKey(
         Conversation, related_name="belongs_in", on_delete=models.CASCADE)
     created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['belongs_in', 'created_at', 'id'],
+                         name='message_history_idx'),
+            models.Index(fields=['belongs_in', 'id'],
+                         name='message_unread_idx'),
+        ]
+
+
+class ReadMarker(models.Model):
+    """How far a participant has read a conversation."""
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name='read_markers')
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='read_markers')
+    last_read_message_id = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'user'], name='unique_read_marker'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    owner = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='timeline_entries')
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name='timeline_entries')
+    # Copied from the post so a timeline page is an index range scan.
+    post_date = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['owner', 'post'], name='unique_timeline_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-post_date', '-post'],
+                         name='timeline_owner_date_idx'),
+        ]
@@ -0,0 +1,178 @@
+import logging
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Notification, NotificationActor, PendingNotification, UserProfile
+
+logger = logging.getLogger(__name__)
+
+# Likes and comments on one post within this many seconds share a row.
+NOTIFICATION_GROUP_WINDOW = getattr(settings, 'NOTIFICATION_GROUP_WINDOW', 24 * 60 * 60)
+NOTIFICATION_OUTBOX_BATCH = getattr(settings, 'NOTIFICATION_OUTBOX_BATCH', 500)
+
+AGGREGATED_TYPES = {
+    "like": "liked your post.",
+    "comment": "commented on your post.",
+}
+
+
+def group_key(notify_type, actor_id, post_id=None, moment=None):
+    """The key events are coalesced under, or None for one row per event."""
+    if notify_type == "follow_request":
+        # One row per requester, so toggling follow never piles up requests.
+        return f"follow_request:{actor_id}"
+    if notify_type in AGGREGATED_TYPES:
+        window = int((moment or timezone.now()).timestamp() // NOTIFICATION_GROUP_WINDOW)
+        return f"{notify_type}:{post_id}:{window}"
+    return None
+
+
+def notify(actor, recipient, notify_type, text, post=None):
+    """Queues an event for recipient in the notification outbox.
+
+    The event is stored in the caller's transaction and delivered once it
+    commits, by the drain_notifications task, or straight away in eager mode.
+    """
+    PendingNotification.objects.create(
+        notify_from=actor, notify_to=recipient, notify_type=notify_type, notify_text=text, notify_post=post,
+        created_at=timezone.now())
+    # Read per call so tests can switch modes with override_settings.
+    if getattr(settings, 'NOTIFICATION_OUTBOX_EAGER', False):
+        drain()
+    else:
+        transaction.on_commit(_schedule_drain)
+
+
+def _schedule_drain():
+    from .tasks import drain_notifications
+
+    try:
+        drain_notifications.delay()
+    except Exception:
+        # The event is already stored; the periodic drain delivers it once the broker is back.
+        logger.exception("Could not schedule a notification drain")
+
+
+def drain(batch_size=NOTIFICATION_OUTBOX_BATCH):
+    """Delivers queued events in batches and returns how many were delivered.
+
+    Each batch is delivered and removed from the outbox in one transaction,
+    so a failure leaves it queued for the next attempt and no event is
+    delivered twice. Concurrent drains skip each other's locked rows.
+    """
+    delivered = 0
+    while True:
+        with transaction.atomic():
+            batch = list(PendingNotification.objects.select_for_update(skip_locked=True).order_by('id')[:batch_size])
+            if not batch:
+                return delivered
+            deliver(batch)
+            PendingNotification.objects.filter(id__in=[event.id for event in batch]).delete()
+        delivered += len(batch)
+
+
+def deliver(events):
+    """Turns events into inbox rows, coalescing them into existing rows when possible.
+
+    The first event of a group creates its row; events from further actors
+    move it to the top and bump actor_count, and repeats from an actor who
+    is already counted (a like, unlike, like toggle) only move it. Rows are
+    inserted with bulk_create, so the cost grows with the number of groups
+    touched rather than the number of events.
+    """
+    unread = Counter()
+    single, groups = [], {}
+    for event in events:
+        key = group_key(event.notify_type, event.notify_from_id, event.notify_post_id, event.created_at)
+        if key is None:
+            single.append(event)
+        else:
+            groups.setdefault((event.notify_to_id, key), []).append(event)
+
+    Notification.objects.bulk_create([
+        Notification(notify_from_id=event.notify_from_id, notify_to_id=event.notify_to_id,
+                     notify_type=event.notify_type, notify_text=event.notify_text,
+                     notify_post_id=event.notify_post_id)
+        for event in single])
+    unread.update(event.notify_to_id for event in single)
+    if not groups:
+        _add_unread(unread)
+        return
+
+    existing = {
+        (notification.notify_to_id, notification.group_key): notification
+        for notification in Notification.objects.filter(
+            notify_to__in={recipient for recipient, _ in groups}, group_key__in={key for _, key in groups})
+        if (notification.notify_to_id, notification.group_key) in groups
+    }
+    # A group created by a concurrent drain fails the insert, rolling the
+    # batch back for the task to retry.
+    created = Notification.objects.bulk_create([
+        Notification(notify_from_id=grouped[-1].notify_from_id, notify_to_id=recipient,
+                     notify_type=grouped[-1].notify_type, notify_text=grouped[-1].notify_text,
+                     notify_post_id=grouped[-1].notify_post_id, group_key=key,
+                     actor_count=len({event.notify_from_id for event in grouped}))
+        for (recipient, key), grouped in groups.items() if (recipient, key) not in existing])
+    unread.update(notification.notify_to_id for notification in created)
+    _add_unread(unread)
+
+    counted = set(NotificationActor.objects.filter(
+        notification__in=existing.values(),
+        actor__in={event.notify_from_id for grouped in groups.values() for event in grouped},
+    ).values_list('notification_id', 'actor_id'))
+    notifications = {**existing, **{(row.notify_to_id, row.group_key): row for row in created}}
+    new_actors = {(notifications[group].pk, event.notify_from_id)
+                  for group, grouped in groups.items() for event in grouped} - counted
+    NotificationActor.objects.bulk_create(
+        [NotificationActor(notification_id=notification_id, actor_id=actor_id)
+         for notification_id, actor_id in new_actors], ignore_conflicts=True)
+
+    added = Counter(notification_id for notification_id, _ in new_actors)
+    for group, notification in existing.items():
+        latest = groups[group][-1]
+        Notification.objects.filter(pk=notification.pk).update(
+            notify_from=latest.notify_from_id, notify_text=latest.notify_text, notify_time=timezone.now(),
+            actor_count=F('actor_count') + added[notification.pk])
+        # A row the recipient had already seen becomes unread again.
+        _count_unread(notification.notify_to_id, seen_since=notification.notify_time)
+
+
+def _add_unread(increments):
+    for recipient, count in increments.items():
+        UserProfile.objects.filter(user=recipient).update(unread_notifications=F('unread_notifications') + count)
+
+
+def _count_unread(recipient, seen_since=None):
+    profiles = UserProfile.objects.filter(user=recipient)
+    if seen_since is not None:
+        profiles = profiles.filter(notifications_seen_at__gte=seen_since)
+    profiles.update(unread_notifications=F('unread_notifications') + 1)
+
+
+def mark_seen(user, moment=None):
+    UserProfile.objects.filter(user=user).update(
+        unread_notifications=0, notifications_seen_at=moment or timezone.now())
+
+
+def withdraw(actor, recipient, notify_type):
+    """Drops a keyed notification whose cause was undone, such as a cancelled follow request."""
+    PendingNotification.objects.filter(notify_from=actor, notify_to=recipient, notify_type=notify_type).delete()
+    withdrawn = Notification.objects.filter(notify_to=recipient, group_key=group_key(notify_type, actor.id))
+    notify_time = withdrawn.values_list('notify_time', flat=True).first()
+    if notify_time is None:
+        return
+    withdrawn.delete()
+    UserProfile.objects.filter(
+        user=recipient, unread_notifications__gt=0, notifications_seen_at__lt=notify_time,
+    ).update(unread_notifications=F('unread_notifications') - 1)
+
+
+def notification_text(notification):
+    """Display text; coalesced rows read "alice and 3 others liked your post."."""
+    others = notification.actor_count - 1
+    if others < 1 or notification.notify_type not in AGGREGATED_TYPES:
+        return notification.notify_text
+    return (f"{notification.notify_from.username} and {others} "
+            f"{'other' if others == 1 else 'others'} {AGGREGATED_TYPES[notification.notify_type]}")
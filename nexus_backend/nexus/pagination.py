@@ -0,0 +1,39 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+
+
+def clamp_limit(limit, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    if not limit or limit < 1:
+        return default
+    return min(limit, maximum)
+
+
+def encode_cursor(moment, pk):
+    raw = f"{moment.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Returns the (datetime, pk) pair behind a cursor, raising ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        moment, pk = raw.rsplit("|", 1)
+        return datetime.fromisoformat(moment), int(pk)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def keyset_before(date_field, pk_field, moment, pk):
+    # Rows strictly after the cursor in (date DESC, pk DESC) order. Written as a
+    # range plus an exclusion rather than an OR so the date index still drives
+    # the scan and the ordering.
+    return Q(**{f"{date_field}__lte": moment}) & ~Q(**{date_field: moment, f"{pk_field}__gte": pk})
+
+
+def keyset_after(date_field, pk_field, moment, pk):
+    # Rows strictly after the cursor in (date ASC, pk ASC) order.
+    return Q(**{f"{date_field}__gte": moment}) & ~Q(**{date_field: moment, f"{pk_field}__lte": pk})
@@ -1,8 +1,9 @@
+from asgiref.sync import sync_to_async
 from ninja import NinjaAPI, Schema, Router, File, Form, UploadedFile
-from ninja.responses import Response
+from .renderers import FastJSONParser, FastJSONRenderer, Response
 from rest_framework.permissions import IsAuthenticated
 from .models import Post, UserProfile, Comment, Notification
-from ninja_jwt.authentication import JWTAuth
+from .authentication import AsyncCachedJWTAuth, CachedJWTAuth
 from .schema import PostSchema, CommentSchema, DeleteCommentSchema, DeletePostSchema, EditPostSchema, SearchLikeSchema
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
@@ -10,13 +11,19 @@ import os
 from django.utils import timezone
 from django.utils.timesince import timesince
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from . import feed_cache, images, media, timeline
+from .avatars import avatar_urls, profile_avatar_url
+from .executor import run_blocking
+from .notifications import notify
 
 
-post_router = NinjaAPI(urls_namespace='postAPI')
+post_router = NinjaAPI(urls_namespace='postAPI', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 post_message = "Post Not Found"
 
-@post_router.post("/view-comments", auth=JWTAuth())
+@post_router.post("/view-comments", auth=CachedJWTAuth())
 def get_comments(request, payload: PostSchema) -> Response:
     try:
         post = Post.objects.get(post_id=payload.post_id)
@@ -26,31 +33,26 @@ def get_comments(request, payload: PostSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    comments = Comment.objects.filter(comment_post=post)
+    comments = list(Comment.objects.filter(comment_post=post).select_related(
+        'comment_user').order_by('comment_date'))
+    avatars = avatar_urls(comment.comment_user_id for comment in comments)
 
     response_data = []
     for comment in comments:
-        commented_by = UserProfile.objects.get(user=comment.comment_user)
-
-        profile_picture_url = (
-            commented_by.profile_image.url if commented_by.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
-
-        )
         time_ago = timesince(comment.comment_date)
         response_data.append({
             "comment_id": comment.comment_id,
             "comment_user": comment.comment_user.username,
             "comment_message": comment.comment_message,
             "time_lapsed": time_ago,
-            "profile_picture": profile_picture_url,
-            "is_owner": True if comment.comment_user == request.user or request.user == post.user_id else False
+            "profile_picture": avatars[comment.comment_user_id],
+            "is_owner": True if comment.comment_user_id == request.user.id or request.user.id == post.user_id_id else False
         })
 
     return Response(response_data, status=200)
 
 
-@post_router.post("/get-post", auth=JWTAuth())
+@post_router.post("/get-post", auth=CachedJWTAuth())
 def like_post(request, payload: PostSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -60,27 +62,24 @@ def like_post(request, payload: PostSchema) -> Response:
         post = Post.objects.get(post_id=payload.post_id)
     except Post.DoesNotExist:
         return Response({"error": post_message}, status=404)
-    post_image_url = os.path.join(
-        settings.MEDIA_URL, f'posts/{post.post_id}.{post.post_image.name.split(".")[-1]}')
+    post_image_url = images.image_url(post.image_variants, 'full', post.post_image.url) if post.post_image else None
 
-    likes_count = post.likes_list.count()
     current_user_has_liked = False
     if (post.likes_list.filter(id=request.user.id).exists()):
         current_user_has_liked = True
 
     user_profile = UserProfile.objects.get(user=post.user_id)
-    profile_picture_url = (
-        user_profile.profile_image.url if user_profile.profile_image else f"{
-            settings.MEDIA_URL}profile_images/default.png"
-    )
+    profile_picture_url = profile_avatar_url(user_profile)
 
     object_to_return = {
         "id": post.post_id,
         "user": post.user_id.username,
         "post_image": post_image_url,
+        "post_image_variants": images.variant_urls(post.image_variants),
         "created_at": timesince(post.post_date),
         "caption": post.caption,
-        "likes_count": likes_count,
+        "likes_count": post.like_count,
+        "comments_count": post.comment_count,
         "has_liked": current_user_has_liked,
         "profile_picture": profile_picture_url,
         "is_owner": True if post.user_id == request.user else False
@@ -88,7 +87,7 @@ def like_post(request, payload: PostSchema) -> Response:
     return Response(object_to_return, status=201)
 
 
-@post_router.post("/toggle-like", auth=JWTAuth())
+@post_router.post("/toggle-like", auth=CachedJWTAuth())
 def like_post(request, payload: PostSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -99,26 +98,33 @@ def like_post(request, payload: PostSchema) -> Response:
     except Post.DoesNotExist:
         return Response({"error": post_message}, status=404)
 
+    # Work on the through table directly so the counter only moves when a row
+    # was actually inserted or removed, even under concurrent toggles.
+    likes = Post.likes_list.through.objects
     message = ""
-    if not post.likes_list.filter(id=request.user.id).exists():
-        post.likes_list.add(request.user)
-        message = "Post liked successfully"
-        Notification.objects.create(
-            notify_from=request.user,  
-            notify_to=post.user_id,  
-            notify_type="like",
-            notify_text=f"{request.user.username} liked your post.",
-            notify_post=post  
-        )
-    else:
-        post.likes_list.remove(request.user)
-        message = "Post unliked successfully"
-
-    post.save()
+    liked = False
+    with transaction.atomic():
+        unliked, _ = likes.filter(post=post, user=request.user).delete()
+        if unliked:
+            Post.objects.filter(pk=post.pk).update(like_count=F('like_count') - 1)
+            message = "Post unliked successfully"
+        else:
+            _, liked = likes.get_or_create(post=post, user=request.user)
+            if liked:
+                Post.objects.filter(pk=post.pk).update(like_count=F('like_count') + 1)
+            message = "Post liked successfully"
+
+    # Other viewers only need the new count; the liker's own has_liked changed.
+    feed_cache.patch_like_count(
+        post.pk, Post.objects.values_list('like_count', flat=True).get(pk=post.pk))
+    feed_cache.invalidate_viewers([request.user.id])
+
+    if liked:
+        notify(request.user, post.user_id, "like", f"{request.user.username} liked your post.", post)
 
     return Response({"success": True, "message": message}, status=201)
 
-@post_router.post("/make-comment", auth=JWTAuth())
+@post_router.post("/make-comment", auth=CachedJWTAuth())
 def create_comment(request, payload: CommentSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -129,21 +135,19 @@ def create_comment(request, payload: CommentSchema) -> Response:
     except Post.DoesNotExist:
         return Response({"error": post_message}, status=404)
 
-    comment = Comment.objects.create(
-        comment_post=post,
-        comment_user=request.user,
-        comment_message=payload.comment_message,
-        comment_date=timezone.now()
-    )
-
-    Notification.objects.create(
-        notify_from=request.user,
-        notify_to=post.user_id,  
-        notify_type="comment",
-        notify_text=f"{request.user.username} commented on your post: {
-            payload.comment_message}",
-        notify_post=post
-    )
+    with transaction.atomic():
+        comment = Comment.objects.create(
+            comment_post=post,
+            comment_user=request.user,
+            comment_message=payload.comment_message,
+            comment_date=timezone.now()
+        )
+        Post.objects.filter(pk=post.pk).update(comment_count=F('comment_count') + 1)
+    feed_cache.patch_comment_count(
+        post.pk, Post.objects.values_list('comment_count', flat=True).get(pk=post.pk))
+
+    notify(request.user, post.user_id, "comment", f"{request.user.username} commented on your post: {
+        payload.comment_message}", post)
 
     return Response({
         "success": True,
@@ -155,7 +159,7 @@ def create_comment(request, payload: CommentSchema) -> Response:
     }, status=201)
 
 
-@post_router.post("/delete-comment", auth=JWTAuth())
+@post_router.post("/delete-comment", auth=CachedJWTAuth())
 def delete_comment(request, payload: DeleteCommentSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -167,7 +171,16 @@ def delete_comment(request, payload: DeleteCommentSchema) -> Response:
         if comment.comment_user != request.user and comment.comment_post.user_id != request.user:
             return Response({"error": "You do not have permission to delete this comment."}, status=403)
 
-        comment.delete()
+        # Only the request that actually removed the row gives the count back,
+        # so concurrent deletes of the same comment cannot decrement twice.
+        with transaction.atomic():
+            deleted, _ = Comment.objects.filter(pk=comment.pk).delete()
+            if deleted:
+                Post.objects.filter(pk=comment.comment_post_id).update(
+                    comment_count=F('comment_count') - 1)
+        if deleted:
+            feed_cache.patch_comment_count(comment.comment_post_id, Post.objects.values_list(
+                'comment_count', flat=True).get(pk=comment.comment_post_id))
 
         return Response({"success": True, "message": "Comment deleted successfully"}, status=201)
 
@@ -175,21 +188,32 @@ def delete_comment(request, payload: DeleteCommentSchema) -> Response:
         return Response({"error": "Comment not found"}, status=404)
 
 
-@post_router.post("/create-post", auth=JWTAuth())
-def create_post(request, caption: str = Form(None), post_image: UploadedFile = File(None)) -> Response:
+@post_router.post("/create-post", auth=AsyncCachedJWTAuth())
+async def create_post(request, caption: str = Form(None), post_image: UploadedFile = File(None)) -> Response:
 
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    post = Post.objects.create(user_id=request.user, caption=caption)
+    if post_image:
+        try:
+            await run_blocking(media.check_upload, post_image)
+        except media.UploadRejected as e:
+            return Response({"error": str(e)}, status=e.status)
+
+    post = await Post.objects.acreate(user_id=request.user, caption=caption)
 
     if post_image:
-        ext = post_image.name.split('.')[-1]  
-        image_name = f'posts/{post.post_id}.{ext}'
-        image_path = default_storage.save(
-            image_name, ContentFile(post_image.read()))
+        try:
+            image_path = await media.astore_upload(post_image)
+        except media.UploadRejected as e:
+            await post.adelete()
+            return Response({"error": str(e)}, status=e.status)
         post.post_image = image_path
-        post.save()
+        await post.asave()
+        await sync_to_async(images.schedule)('post', post.post_id)
+
+    await sync_to_async(timeline.fan_out_post)(post)
+    await sync_to_async(feed_cache.invalidate_author)(request.user)
 
     return Response({
         "success": True,
@@ -199,7 +223,7 @@ def create_post(request, caption: str = Form(None), post_image: UploadedFile = F
     }, status=201)
 
 
-@post_router.post("/delete-post", auth=JWTAuth())
+@post_router.post("/delete-post", auth=CachedJWTAuth())
 def delete_post(request, payload: DeletePostSchema) -> Response:
    
     if not request.user.is_authenticated:
@@ -213,10 +237,13 @@ def delete_post(request, payload: DeletePostSchema) -> Response:
     if post.user_id != request.user:
         return Response({"error": "You are not authorized to delete this post"}, status=403)
 
-    if post.post_image:
-        post.post_image.delete(save=False)
-
-    post.delete()
+    # The image is let go with the row, so a failed delete never leaves the post without its file.
+    with transaction.atomic():
+        timeline.retract_post(post)
+        post.delete()
+        if post.post_image:
+            media.discard(post.post_image.name, post.image_variants)
+    feed_cache.invalidate_author(request.user)
 
     return Response({
         "success": True,
@@ -225,7 +252,7 @@ def delete_post(request, payload: DeletePostSchema) -> Response:
     }, status=200)
 
 
-@post_router.post("/edit-post", auth=JWTAuth())
+@post_router.post("/edit-post", auth=CachedJWTAuth())
 def edit_post(request, payload: EditPostSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
@@ -240,6 +267,7 @@ def edit_post(request, payload: EditPostSchema) -> Response:
 
     post.caption = payload.caption
     post.save()
+    feed_cache.invalidate_author(request.user)
 
     return Response({
         "success": True,
@@ -249,7 +277,7 @@ def edit_post(request, payload: EditPostSchema) -> Response:
     }, status=200)
 
 
-@post_router.post("/search-like", auth=JWTAuth())
+@post_router.post("/search-like", auth=CachedJWTAuth())
 def search_user_in_post_likes(request, payload: SearchLikeSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -260,23 +288,14 @@ def search_user_in_post_likes(request, payload: SearchLikeSchema) -> Response:
     except Post.DoesNotExist:
         return Response({"error": post_message}, status=404)
 
-    liked_users = post.likes_list.filter(username__icontains=payload.username)
+    liked_users = list(post.likes_list.filter(username__icontains=payload.username))
+    avatars = avatar_urls(user.id for user in liked_users)
 
     liked_users_data = []
     for user in liked_users:
-        try:
-            user_profile = UserProfile.objects.get(user=user)
-            profile_image_url = (
-                user_profile.profile_image.url if user_profile.profile_image else f"{
-                    settings.MEDIA_URL}profile_images/default.png"
-            )
-        except UserProfile.DoesNotExist:
-            profile_image_url = f"{
-                settings.MEDIA_URL}profile_images/default.png"
-
         liked_users_data.append({
             "username": user.username,
-            "profile_picture": profile_image_url,
+            "profile_picture": avatars[user.id],
         })
 
     return Response({
@@ -0,0 +1,154 @@
+import asyncio
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.utils.module_loading import import_string
+from .renderers import dumps, loads
+
+CHAT_PUBSUB_BACKEND = getattr(settings, 'CHAT_PUBSUB_BACKEND', 'nexus.pubsub.InProcessPubSub')
+CHAT_PUBSUB_URL = getattr(settings, 'CHAT_PUBSUB_URL', '')
+CHAT_SUBSCRIBER_BUFFER = getattr(settings, 'CHAT_SUBSCRIBER_BUFFER', 256)
+
+
+class SubscriptionOverflow(Exception):
+    """The subscriber fell too far behind and lost messages."""
+
+
+class Subscription:
+
+    async def get(self):
+        """Waits for the next message published on the channel."""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+
+class PubSubBackend:
+    """Carries chat events from the process that stores a message to every
+    process holding a socket for that conversation.
+
+    publish() is called from synchronous request handlers; subscribe() is
+    awaited on the event loop that will consume the subscription, and the
+    subscription is live once it returns.
+    """
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    async def subscribe(self, channel):
+        raise NotImplementedError
+
+
+class _QueueSubscription(Subscription):
+
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=CHAT_SUBSCRIBER_BUFFER)
+        self.overflowed = False
+
+    def deliver(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The consuming loop has shut down.
+            pass
+
+    def _put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # The queue is non-empty, so a pending get() returns and sees this.
+            self.overflowed = True
+
+    async def get(self):
+        if self.overflowed:
+            raise SubscriptionOverflow(self.channel)
+        message = await self.queue.get()
+        if self.overflowed:
+            raise SubscriptionOverflow(self.channel)
+        return message
+
+    async def close(self):
+        self.backend._unsubscribe(self)
+
+
+class InProcessPubSub(PubSubBackend):
+    """Delivers within this process only; for single-node deployments and tests."""
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.deliver(message)
+
+    async def subscribe(self, channel):
+        subscription = _QueueSubscription(self, channel)
+        with self.lock:
+            self.subscribers[channel].add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.channel]
+
+
+class _RedisSubscription(Subscription):
+
+    def __init__(self, client, pubsub):
+        self.client = client
+        self.pubsub = pubsub
+
+    async def get(self):
+        while True:
+            item = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            if item is not None:
+                return loads(item['data'])
+
+    async def close(self):
+        await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+class RedisPubSub(PubSubBackend):
+    """Delivers across processes and hosts through Redis PUBLISH/SUBSCRIBE."""
+
+    def __init__(self, url=None):
+        import redis
+
+        self.url = url or CHAT_PUBSUB_URL
+        self.client = redis.Redis.from_url(self.url)
+
+    def publish(self, channel, message):
+        self.client.publish(channel, dumps(message))
+
+    async def subscribe(self, channel):
+        from redis import asyncio as aioredis
+
+        client = aioredis.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(channel)
+        return _RedisSubscription(client, pubsub)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(CHAT_PUBSUB_BACKEND)()
+    return _backend
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .models import Notification, UserProfile
+
+NOTIFICATION_RETENTION_DAYS = getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90)
+NOTIFICATION_RETENTION_PER_USER = getattr(settings, 'NOTIFICATION_RETENTION_PER_USER', 500)
+NOTIFICATION_RETENTION_BATCH = getattr(settings, 'NOTIFICATION_RETENTION_BATCH', 1000)
+
+
+def counted_unread():
+    # Rows added or bumped since the profile's user last opened the inbox.
+    return Coalesce(Subquery(
+        Notification.objects.filter(notify_to=OuterRef('user'), notify_time__gt=OuterRef('notifications_seen_at'))
+        .order_by().values('notify_to').annotate(n=Count('pk')).values('n')), 0)
+
+
+def _delete_in_batches(notifications, batch_size, offset=0):
+    # Each batch is its own short transaction, so no lock is held for long and
+    # an interrupted run keeps everything it already removed.
+    removed = 0
+    while True:
+        batch = list(notifications.values_list('notification_id', flat=True)[offset:offset + batch_size])
+        if not batch:
+            return removed
+        Notification.objects.filter(notification_id__in=batch).delete()
+        removed += len(batch)
+
+
+def expire_notifications(cutoff, batch_size=NOTIFICATION_RETENTION_BATCH):
+    """Deletes notifications last bumped before cutoff and returns the number removed."""
+    removed = _delete_in_batches(
+        Notification.objects.filter(notify_time__lt=cutoff).order_by('notify_time'), batch_size)
+    # Only users who have not opened their inbox since cutoff can have had the deleted rows counted.
+    UserProfile.objects.filter(notifications_seen_at__lt=cutoff, unread_notifications__gt=0).update(
+        unread_notifications=counted_unread())
+    return removed
+
+
+def cap_inboxes(keep, batch_size=NOTIFICATION_RETENTION_BATCH, after_user=0):
+    """Trims every inbox to its newest keep rows, in user id order.
+
+    Yields (user_id, removed) for each trimmed inbox, so a stopped run can be
+    resumed by passing the last user id it yielded as after_user.
+    """
+    while True:
+        crowded = list(
+            Notification.objects.filter(notify_to__gt=after_user).order_by('notify_to')
+            .values('notify_to').annotate(n=Count('pk')).filter(n__gt=keep)
+            .values_list('notify_to', flat=True)[:batch_size])
+        if not crowded:
+            return
+        for user_id in crowded:
+            removed = _delete_in_batches(
+                Notification.objects.filter(notify_to=user_id).order_by('-notify_time', '-notification_id'),
+                batch_size, offset=keep)
+            UserProfile.objects.filter(user=user_id).update(unread_notifications=counted_unread())
+            yield user_id, removed
+        after_user = crowded[-1]
+
+
+def compact_notifications(days=NOTIFICATION_RETENTION_DAYS, keep=NOTIFICATION_RETENTION_PER_USER,
+                          batch_size=NOTIFICATION_RETENTION_BATCH):
+    """Applies the retention policy; either limit may be None to disable it."""
+    removed = 0
+    if days is not None:
+        removed += expire_notifications(timezone.now() - timezone.timedelta(days=days), batch_size)
+    if keep is not None:
+        removed += sum(trimmed for _, trimmed in cap_inboxes(keep, batch_size))
+    return removed
@@ -85,6 +85,14 @@ class SearchViewerSchema(Schema):
 
 class ConversationMessagesSchema(Schema):
     convo_id: int
+    before_id: Optional[int] = None
+    after_id: Optional[int] = None
+    limit: Optional[int] = None
+
+
+class MarkReadSchema(Schema):
+    convo_id: int
+    message_id: int
 
 
 class NewMessageSchema(Schema):
@@ -0,0 +1,30 @@
+from django.contrib.auth.models import User
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from . import media
+from .models import Comment, Post, Story, UserProfile
+
+
+@receiver(pre_delete, sender=User)
+def release_post_counters(sender, instance, **kwargs):
+    # Deleting a user cascades away their likes and comments without going
+    # through the endpoints, so give the counters back before the rows vanish.
+    Post.objects.filter(likes_list=instance).update(like_count=F('like_count') - 1)
+
+    authored = Comment.objects.filter(
+        comment_user=instance, comment_post=OuterRef('pk')
+    ).order_by().values('comment_post').annotate(n=Count('pk')).values('n')
+    Post.objects.filter(comments__comment_user=instance).exclude(user_id=instance).update(
+        comment_count=F('comment_count') - Subquery(authored))
+
+
+@receiver(pre_delete, sender=User)
+def release_user_media(sender, instance, **kwargs):
+    # The cascade removes the user's posts, stories and profile without
+    # discarding their images, so drop their blob references here, inside
+    # the delete's transaction; files go only once it commits.
+    names = [*Post.objects.filter(user_id=instance).values_list('post_image', flat=True),
+             *Story.objects.filter(story_user=instance).values_list('story_image', flat=True),
+             *UserProfile.objects.filter(user=instance).values_list('profile_image', flat=True)]
+    media.release(*names)
@@ -1,18 +1,26 @@
+from asgiref.sync import sync_to_async
 from ninja import NinjaAPI, Router, File, Form, UploadedFile
-from ninja.responses import Response
-from ninja_jwt.authentication import JWTAuth
+from .renderers import FastJSONParser, FastJSONRenderer, Response
+from .authentication import AsyncCachedJWTAuth, CachedJWTAuth
 from .models import Story, UserProfile, User
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
-from .schema import ViewStorySchema, ViewUserStorySchema, HideUserFromStorySchema, UpdateStoryVisibilitySchema, SearchViewerSchema
+from .schema import ViewStorySchema, ViewUserStorySchema, HideUserFromStorySchema, UpdateStoryVisibilitySchema, SearchViewerSchema, UserSchema
 from django.core.exceptions import ObjectDoesNotExist
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Exists, F, Max, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from .avatars import aavatar_urls, avatar_urls, profile_avatar_url
+from .executor import run_blocking
+from . import images, media, story_views
 
-story_router = NinjaAPI(urls_namespace='storyAPI')
+story_router = NinjaAPI(urls_namespace='storyAPI', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 story_message = "Story Not Found"
 
-@story_router.post("/hide-user-from-story", auth=JWTAuth())
+@story_router.post("/hide-user-from-story", auth=CachedJWTAuth())
 def hide_user_from_story(request, payload: HideUserFromStorySchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -43,21 +51,29 @@ def hide_user_from_story(request, payload: HideUserFromStorySchema) -> Response:
     return Response({"success": True, "message": f"User {user_to_hide.username} is now hidden from the story"}, status=200)
 
 
-@story_router.post("/create-story", auth=JWTAuth())
-def create_story(request, caption: str = Form(None), post_image: UploadedFile = File()) -> Response:
+@story_router.post("/create-story", auth=AsyncCachedJWTAuth())
+async def create_story(request, caption: str = Form(None), post_image: UploadedFile = File()) -> Response:
 
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    story = Story.objects.create(story_user=request.user, story_text=caption)
+    if post_image:
+        try:
+            await run_blocking(media.check_upload, post_image)
+        except media.UploadRejected as e:
+            return Response({"error": str(e)}, status=e.status)
+
+    story = await Story.objects.acreate(story_user=request.user, story_text=caption)
 
     if post_image:
-        ext = post_image.name.split('.')[-1]
-        image_name = f'stories/{story.story_id}.{ext}'
-        image_path = default_storage.save(
-            image_name, ContentFile(post_image.read()))
+        try:
+            image_path = await media.astore_upload(post_image)
+        except media.UploadRejected as e:
+            await story.adelete()
+            return Response({"error": str(e)}, status=e.status)
         story.story_image = image_path
-        story.save()
+        await story.asave()
+        await sync_to_async(images.schedule)('story', story.story_id)
 
     return Response({
         "success": True,
@@ -68,7 +84,7 @@ def create_story(request, caption: str = Form(None), post_image: UploadedFile =
     }, status=201)
 
 
-@story_router.post("/view-stories", auth=JWTAuth())
+@story_router.post("/view-stories", auth=CachedJWTAuth())
 def get_user_stories(request, payload: ViewUserStorySchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -81,10 +97,13 @@ def get_user_stories(request, payload: ViewUserStorySchema) -> Response:
     except UserProfile.DoesNotExist:
         return Response({"error": "User profile not found"}, status=404)
 
-    stories = Story.objects.filter(story_user=user_profile.user).exclude(
-        hidden_from=request.user).order_by('story_id')
-
     is_owner = request.user == user_profile.user
+    if is_owner:
+        story_views.flush_all()
+    else:
+        story_views.flush_viewer(request.user.id)
+
+    stories = visible_stories(request.user).filter(story_user=user_profile.user).order_by('story_id')
 
     total_stories = stories.count()
 
@@ -96,10 +115,7 @@ def get_user_stories(request, payload: ViewUserStorySchema) -> Response:
 
     if stories.exists():
         story = stories[payload.index]
-        user_profile_image_url = (
-            user_profile.profile_image.url if user_profile.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
-            )
+        user_profile_image_url = profile_avatar_url(user_profile)
 
         # Prepare response data
         return Response({
@@ -109,7 +125,9 @@ def get_user_stories(request, payload: ViewUserStorySchema) -> Response:
             "viewed_by_user_count": viewed_by_user_count,
             "id": story.story_id,
             "caption": story.story_text,
-            "image": story.story_image.url if story.story_image else None,
+            "image": images.image_url(story.image_variants, 'full', story.story_image.url)
+            if story.story_image else None,
+            "image_variants": images.variant_urls(story.image_variants),
             "time": story.story_time.isoformat(),
             "viewed_by_count": story.viewed_by.count() if is_owner else None,
             "profile_image": user_profile_image_url,
@@ -119,26 +137,73 @@ def get_user_stories(request, payload: ViewUserStorySchema) -> Response:
         return Response({"error": "No visible stories found for this user"}, status=404)
 
 
-@story_router.post("/view-story", auth=JWTAuth())
-def mark_story_as_viewed(request, payload: ViewStorySchema) -> Response:
-    # Ensure the user is authenticated
+@story_router.post("/view-reel", auth=AsyncCachedJWTAuth())
+async def view_reel(request, payload: UserSchema) -> Response:
+    """Every live story the viewer may see from one author, oldest first,
+    with seen flags and a prefetch list of media starting at the first
+    unseen story."""
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    try:
-       
-        story = Story.objects.get(pk=payload.story_id)
-       
-    except Story.DoesNotExist:
-        return Response({"error": story_message}, status=404)
-    except ObjectDoesNotExist:
-        return Response({"error": "User not found"}, status=404)
+    is_owner = payload.username == request.user.username
+    if is_owner:
+        await story_views.aflush_all()
+    else:
+        await story_views.aflush_viewer(request.user.id)
+    seen = Story.viewed_by.through.objects.filter(story_id=OuterRef('pk'), user=request.user)
+    reel = (visible_stories(request.user).filter(story_user__username=payload.username)
+            .select_related('story_user').annotate(seen=Exists(seen)).order_by('story_id'))
+    if is_owner:
+        viewers = (Story.viewed_by.through.objects.filter(story_id=OuterRef('pk')).order_by()
+                   .values('story_id').annotate(n=Count('pk')).values('n'))
+        reel = reel.annotate(viewed_by_count=Coalesce(Subquery(viewers), 0))
+    stories = [story async for story in reel]
+
+    if not stories:
+        if not await User.objects.filter(username=payload.username).aexists():
+            return Response({"error": "User profile not found"}, status=404)
+        return Response({"error": "No visible stories found for this user"}, status=404)
 
-    if story.viewed_by.filter(id=request.user.id).exists():
-        return Response({"message": "User has already viewed this story"}, status=200)
+    author = stories[0].story_user
+    avatars = await aavatar_urls([author.id])
+    start_index = next((index for index, story in enumerate(stories) if not story.seen), 0)
 
-    story.viewed_by.add(request.user)
-    story.save()
+    reel_data = []
+    for story in stories:
+        reel_data.append({
+            "id": story.story_id,
+            "caption": story.story_text,
+            "image": images.image_url(story.image_variants, 'full', story.story_image.url)
+            if story.story_image else None,
+            "image_variants": images.variant_urls(story.image_variants),
+            "time": story.story_time.isoformat(),
+            "expires_at": story.expires_at.isoformat(),
+            "seen": story.seen,
+            "viewed_by_count": story.viewed_by_count if is_owner else None,
+        })
+
+    return Response({
+        "username": author.username,
+        "user_id": author.id,
+        "profile_image": avatars[author.id],
+        "is_owner": is_owner,
+        "total_stories": len(stories),
+        "viewed_by_user_count": sum(story.seen for story in stories),
+        "start_index": start_index,
+        "stories": reel_data,
+        # Media in viewing order from where the viewer left off, for the client to fetch ahead.
+        "prefetch": [story["image"] for story in reel_data[start_index:] + reel_data[:start_index] if story["image"]],
+    }, status=200)
+
+
+@story_router.post("/view-story", auth=AsyncCachedJWTAuth())
+async def mark_story_as_viewed(request, payload: ViewStorySchema) -> Response:
+    # Ensure the user is authenticated
+    if not request.user.is_authenticated:
+        return Response({"error": "Unauthorized"}, status=401)
+
+    # Buffered and written in batches; views of unknown stories are dropped when flushed.
+    await story_views.arecord_view(request.user.id, payload.story_id)
 
     return Response({
         "success": True,
@@ -146,62 +211,66 @@ def mark_story_as_viewed(request, payload: ViewStorySchema) -> Response:
     }, status=200)
 
 
-@story_router.get("/friends-stories", auth=JWTAuth())
-def get_friends_with_stories(request) -> Response:
+@story_router.get("/friends-stories", auth=AsyncCachedJWTAuth())
+async def get_friends_with_stories(request) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    try:
-        user_profile = UserProfile.objects.get(user=request.user)
-    except UserProfile.DoesNotExist:
-        return Response({"error": "User profile not found"}, status=404)
+    await story_views.aflush_viewer(request.user.id)
+    tray = [author async for author in stories_tray(request.user)]
+    avatars = await aavatar_urls(author["story_user"] for author in tray)
 
-    friends_with_stories = []
-
-    user_stories = get_user_stories(request.user)
+    # Own stories lead, then authors with something new, most recently active first.
+    tray.sort(key=lambda author: (author["story_user"] != request.user.id,
+                                  author["seen_count"] == author["story_count"],
+                                  -author["last_story_at"].timestamp()))
 
-    if user_stories.exists():
+    friends_with_stories = []
+    for author in tray:
+        yet_to_view = author["seen_count"] < author["story_count"]
         friends_with_stories.append({
-            "username": request.user.username,
-            "user_id": request.user.id,
-            "profile_image": get_profile_image_url(user_profile),
-            "story_index_to_view": get_story_index_to_view(user_stories, request.user),
-            "yet_to_view": has_unviewed_stories(user_stories, request.user)
+            "username": author["story_user__username"],
+            "user_id": author["story_user"],
+            "profile_image": avatars[author["story_user"]],
+            "story_count": author["story_count"],
+            "seen_count": author["seen_count"],
+            "story_index_to_view": author["first_unseen_index"] if yet_to_view else author["story_count"],
+            "yet_to_view": yet_to_view,
         })
 
-    friends = user_profile.following.all()
-    for friend in friends:
-        stories = get_user_stories(friend)
-        if stories.exists():
-            friend_profile = UserProfile.objects.get(user=friend)
-            friends_with_stories.append({
-                "username": friend.username,
-                "user_id": friend.id,
-                "profile_image": get_profile_image_url(friend_profile),
-                "story_index_to_view": get_story_index_to_view(stories, request.user),
-                "yet_to_view": has_unviewed_stories(stories, request.user)
-            })
-
     return Response({"friends_with_stories": friends_with_stories})
 
 
-def get_user_stories(user):
-    return Story.objects.filter(story_user=user).exclude(hidden_from=user)
-
-
-def get_profile_image_url(user_profile):
-    return user_profile.profile_image.url if user_profile.profile_image else f"{settings.MEDIA_URL}profile_images/default.png"
-
-
-def get_story_index_to_view(stories, user):
-    return sum(1 for story in stories if story.viewed_by.filter(id=user.id).exists())
-
-
-def has_unviewed_stories(stories, user):
-    story_index_to_view = get_story_index_to_view(stories, user)
-    return story_index_to_view < stories.count()
-
-@story_router.post("/visibility", auth=JWTAuth())
+def visible_stories(viewer):
+    """Live stories the viewer is allowed to see."""
+    return Story.objects.filter(expires_at__gt=timezone.now()).exclude(hidden_from=viewer)
+
+
+def stories_tray(viewer):
+    """One row per author in the viewer's tray (the viewer and everyone they
+    follow) with live stories: how many there are, how many the viewer has
+    seen and the index of the first unseen one, in a single grouped query."""
+    authors = Q(story_user=viewer) | Q(story_user__in=UserProfile.following.through.objects.filter(
+        userprofile__user=viewer).values('user_id'))
+    stories = visible_stories(viewer).filter(authors)
+    first_unseen = (stories.filter(story_user=OuterRef('story_user')).exclude(viewed_by=viewer)
+                    .order_by('story_id').values('story_id')[:1])
+    seen = Story.viewed_by.through.objects.filter(story_id=OuterRef('pk'), user=viewer)
+    return (
+        stories
+        .annotate(seen=Exists(seen), first_unseen_id=Subquery(first_unseen))
+        .values('story_user', 'story_user__username')
+        .annotate(
+            story_count=Count('pk'),
+            seen_count=Count('pk', filter=Q(seen=True)),
+            first_unseen_index=Count('pk', filter=Q(story_id__lt=F('first_unseen_id'))),
+            last_story_at=Max('story_time'),
+        )
+        .order_by()
+    )
+
+
+@story_router.post("/visibility", auth=CachedJWTAuth())
 def get_story_visibility(request, payload: ViewStorySchema) -> Response:
     # Ensure the user is authenticated
     if not request.user.is_authenticated:
@@ -215,16 +284,17 @@ def get_story_visibility(request, payload: ViewStorySchema) -> Response:
     if request.user != story.story_user:
         return Response({"error": "You are not authorized to view the visibility of this story"}, status=403)
 
-    followers = story.story_user.userprofile.followers.all()
+    followers = list(story.story_user.userprofile.followers.all())
 
-    hidden_users = story.hidden_from.all()
+    hidden_users = set(story.hidden_from.values_list('id', flat=True))
+    avatars = avatar_urls(follower.id for follower in followers)
 
     visibility_data = []
     for follower in followers:
         visibility_data.append({
             "username": follower.username,
-            "profile_picture": follower.userprofile.profile_image.url if follower.userprofile.profile_image else f"{settings.MEDIA_URL}profile_images/default.png",
-            "is_hidden": follower in hidden_users
+            "profile_picture": avatars[follower.id],
+            "is_hidden": follower.id in hidden_users
         })
 
     return Response({
@@ -233,7 +303,7 @@ def get_story_visibility(request, payload: ViewStorySchema) -> Response:
     }, status=200)
 
 
-@story_router.post("/update-visibility", auth=JWTAuth())
+@story_router.post("/update-visibility", auth=CachedJWTAuth())
 def update_story_visibility(request, payload: UpdateStoryVisibilitySchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -266,7 +336,7 @@ def update_story_visibility(request, payload: UpdateStoryVisibilitySchema) -> Re
     }, status=200)
 
 
-@story_router.post("/delete-story", auth=JWTAuth())
+@story_router.post("/delete-story", auth=CachedJWTAuth())
 def delete_story(request, payload: ViewStorySchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -282,10 +352,11 @@ def delete_story(request, payload: ViewStorySchema) -> Response:
             "error": "You are not authorized to delete this story"
         }, status=403)
     
-    if story.story_image: 
-        story.story_image.delete(save=False)
-
-    story.delete()
+    # The image is let go with the row, so a failed delete never leaves the story without its file.
+    with transaction.atomic():
+        story.delete()
+        if story.story_image:
+            media.discard(story.story_image.name, story.image_variants)
 
     return Response({
         "success": True,
@@ -293,7 +364,7 @@ def delete_story(request, payload: ViewStorySchema) -> Response:
     }, status=200)
 
 
-@story_router.post("/search-viewer", auth=JWTAuth())
+@story_router.post("/search-viewer", auth=CachedJWTAuth())
 def search_story_viewer(request, payload: SearchViewerSchema) -> Response:
    
     if not request.user.is_authenticated:
@@ -307,24 +378,16 @@ def search_story_viewer(request, payload: SearchViewerSchema) -> Response:
     if request.user != story.story_user:
         return Response({"error": "You are not authorized to view viewers of this story"}, status=403)
 
-    viewers = story.viewed_by.filter(username__icontains=payload.username)
+    story_views.flush_all()
+    viewers = list(story.viewed_by.filter(username__icontains=payload.username))
+    avatars = avatar_urls(viewer.id for viewer in viewers)
 
     viewers_data = []
     for viewer in viewers:
-        try:
-            viewer_profile = UserProfile.objects.get(user=viewer)
-            profile_image_url = (
-                viewer_profile.profile_image.url if viewer_profile.profile_image else f"{
-                    settings.MEDIA_URL}profile_images/default.png"
-            )
-        except UserProfile.DoesNotExist:
-            profile_image_url = f"{
-                settings.MEDIA_URL}profile_images/default.png"
-
         viewers_data.append({
             "id": viewer.id,
             "username": viewer.username,
-            "profile_picture": profile_image_url,
+            "profile_picture": avatars[viewer.id],
         })
 
     return Response({
@@ -0,0 +1,208 @@
+"""Write-behind buffer for story views.
+
+Views are held in memory per process and written in batches: when the
+buffer fills, when a view arrives after STORY_VIEW_FLUSH_INTERVAL, and from
+a background thread every STORY_VIEW_FLUSH_INTERVAL seconds so a quiet
+worker does not sit on them. View counts are therefore eventually
+consistent: views buffered in other workers reach story owners up to one
+interval late, and a process that is killed outright loses at most its last
+interval of views.
+
+A viewer's own views are also noted under their id in the shared cache, so
+whichever worker serves their next read writes them first (see
+flush_viewer). Two views by the same viewer recorded at the same moment in
+different workers may race for that note; the one that loses is still
+written with its worker's next batch.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from .models import Story
+
+logger = logging.getLogger(__name__)
+
+STORY_VIEW_BUFFER_SIZE = getattr(settings, 'STORY_VIEW_BUFFER_SIZE', 500)
+STORY_VIEW_FLUSH_INTERVAL = getattr(settings, 'STORY_VIEW_FLUSH_INTERVAL', 1)
+STORY_VIEW_SHARED_TIMEOUT = getattr(settings, 'STORY_VIEW_SHARED_TIMEOUT', 60)
+
+StoryView = Story.viewed_by.through
+
+
+class _ViewBuffer:
+    """Story views waiting to be written, by viewer id."""
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.pending = defaultdict(set)
+        self.count = 0
+        self.next_flush = time.monotonic() + interval
+        self.lock = threading.Lock()
+
+    def add(self, viewer_id, story_id):
+        """Buffers a view and says whether the buffer is due for a flush."""
+        with self.lock:
+            stories = self.pending[viewer_id]
+            if story_id not in stories:
+                stories.add(story_id)
+                self.count += 1
+            return self.count >= self.size or time.monotonic() >= self.next_flush
+
+    def has(self, viewer_id=None):
+        if viewer_id is None:
+            return self.count > 0
+        return viewer_id in self.pending
+
+    def take(self, viewer_id=None):
+        """Removes and returns (story_id, viewer_id) pairs, for one viewer or everyone."""
+        with self.lock:
+            if viewer_id is None:
+                taken, self.pending = self.pending, defaultdict(set)
+                self.next_flush = time.monotonic() + self.interval
+            else:
+                taken = {viewer_id: self.pending.pop(viewer_id, set())}
+            views = [(story_id, viewer) for viewer, stories in taken.items() for story_id in stories]
+            self.count -= len(views)
+            return views
+
+    def put_back(self, views):
+        with self.lock:
+            for story_id, viewer_id in views:
+                if story_id not in self.pending[viewer_id]:
+                    self.pending[viewer_id].add(story_id)
+                    self.count += 1
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.count = 0
+            self.next_flush = time.monotonic() + self.interval
+
+
+_buffer = _ViewBuffer(STORY_VIEW_BUFFER_SIZE, STORY_VIEW_FLUSH_INTERVAL)
+
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def flush_pending():
+    """One tick of the background flusher."""
+    try:
+        flush_all()
+    except Exception:
+        # The views went back into the buffer; the next tick retries them.
+        logger.exception("Could not flush buffered story views")
+
+
+def _flush_periodically(interval):
+    while True:
+        time.sleep(interval)
+        flush_pending()
+        # The thread outlives any request, so it must not hold a connection between ticks.
+        connection.close()
+
+
+def start_flusher():
+    """Starts this process's background flusher unless it is already running.
+
+    Called on every buffered view, so it is (re)started lazily in each
+    worker, including after a fork, which does not carry threads over.
+    """
+    global _flusher
+    if _flusher is not None and _flusher.is_alive():
+        return
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = threading.Thread(target=_flush_periodically, args=(STORY_VIEW_FLUSH_INTERVAL,),
+                                        name='nexus-story-views', daemon=True)
+            _flusher.start()
+
+
+def _shared_key(viewer_id):
+    return f'story_views:pending:{viewer_id}'
+
+
+def _shared_note(noted, story_id):
+    """The viewer's noted story ids with story_id added, or None if it is already there."""
+    noted = noted or []
+    return None if story_id in noted else noted + [story_id]
+
+
+def record_view(viewer_id, story_id):
+    """Records that viewer_id saw story_id; written in a batch later, see flush."""
+    start_flusher()
+    noted = _shared_note(cache.get(_shared_key(viewer_id)), story_id)
+    if noted is not None:
+        cache.set(_shared_key(viewer_id), noted, STORY_VIEW_SHARED_TIMEOUT)
+    if _buffer.add(viewer_id, story_id):
+        flush()
+
+
+async def arecord_view(viewer_id, story_id):
+    start_flusher()
+    noted = _shared_note(await cache.aget(_shared_key(viewer_id)), story_id)
+    if noted is not None:
+        await cache.aset(_shared_key(viewer_id), noted, STORY_VIEW_SHARED_TIMEOUT)
+    if _buffer.add(viewer_id, story_id):
+        await sync_to_async(flush)()
+
+
+def flush(viewer_id=None, shared=()):
+    """Writes buffered views, everyone's or only viewer_id's, and returns how many were flushed.
+
+    shared adds the story ids noted for viewer_id by any worker. Views of
+    stories deleted in the meantime are dropped; repeats are ignored by the
+    unique (story, user) constraint. On failure the views go back into the
+    buffer for the next flush.
+    """
+    views = list(set(_buffer.take(viewer_id)) | {(story_id, viewer_id) for story_id in shared})
+    if not views:
+        return 0
+    try:
+        live = set(Story.objects.filter(
+            story_id__in={story_id for story_id, _ in views}).values_list('story_id', flat=True))
+        created = StoryView.objects.bulk_create(
+            [StoryView(story_id=story_id, user_id=viewer) for story_id, viewer in views if story_id in live],
+            ignore_conflicts=True)
+    except Exception:
+        _buffer.put_back(views)
+        raise
+    return len(created)
+
+
+def flush_viewer(viewer_id):
+    """Read-your-writes: makes the viewer's own views, buffered in any worker, visible before a read."""
+    shared = cache.get(_shared_key(viewer_id)) or []
+    if shared or _buffer.has(viewer_id):
+        flush(viewer_id, shared)
+    if shared:
+        cache.delete(_shared_key(viewer_id))
+
+
+async def aflush_viewer(viewer_id):
+    shared = await cache.aget(_shared_key(viewer_id)) or []
+    if shared or _buffer.has(viewer_id):
+        await sync_to_async(flush)(viewer_id, shared)
+    if shared:
+        await cache.adelete(_shared_key(viewer_id))
+
+
+def flush_all():
+    # For story owners reading view counts, which include every view buffered in this process.
+    if _buffer.has():
+        flush()
+
+
+async def aflush_all():
+    if _buffer.has():
+        await sync_to_async(flush)()
+
+
+atexit.register(flush_all)
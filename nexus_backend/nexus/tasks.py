@@ -0,0 +1,28 @@
+from celery import shared_task
+from . import authentication, expiry, images, notifications, retention
+
+
+@shared_task
+def compact_tokens(batch_size=1000):
+    return authentication.compact_tokens(batch_size)
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={'max_retries': 5})
+def drain_notifications():
+    # Undelivered events stay in the outbox, so retries and the periodic drain pick them up.
+    return notifications.drain()
+
+
+@shared_task
+def compact_notifications():
+    return retention.compact_notifications()
+
+
+@shared_task
+def expire_stories():
+    return expiry.expire_stories()
+
+
+@shared_task(autoretry_for=(OSError,), retry_backoff=True, retry_kwargs={'max_retries': 3})
+def generate_image_variants(kind, pk):
+    images.process(kind, pk)
@@ -0,0 +1,81 @@
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
+from .models import Post, TimelineEntry, UserProfile, User
+
+TIMELINE_MAX_LENGTH = getattr(settings, 'TIMELINE_MAX_LENGTH', 800)
+FANOUT_FOLLOWER_LIMIT = getattr(settings, 'TIMELINE_FANOUT_FOLLOWER_LIMIT', 5000)
+
+
+def follower_ids(author):
+    return UserProfile.objects.filter(following=author).values_list('user_id', flat=True)
+
+
+def pull_author_ids(viewer):
+    """Followed authors too popular to fan out; their posts are merged in at read time."""
+    return User.objects.filter(
+        following__user=viewer, userprofile__fanout_on_read=True).values_list('id', flat=True)
+
+
+def is_pull_author(author):
+    return UserProfile.objects.filter(user=author, fanout_on_read=True).exists()
+
+
+def note_new_follower(author):
+    """Switches the author to fan-out on read once they outgrow FANOUT_FOLLOWER_LIMIT."""
+    if follower_ids(author)[FANOUT_FOLLOWER_LIMIT:FANOUT_FOLLOWER_LIMIT + 1].exists():
+        UserProfile.objects.filter(user=author).update(fanout_on_read=True)
+
+
+def fan_out_post(post):
+    """Pushes a new post into the author's own timeline and, unless the author
+    fans out on read, into every follower's timeline."""
+    owners = [post.user_id_id]
+    if not is_pull_author(post.user_id):
+        owners += list(follower_ids(post.user_id))
+
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner_id=owner_id, post=post, post_date=post.post_date)
+         for owner_id in owners],
+        batch_size=1000, ignore_conflicts=True)
+    trim_timelines(owners)
+
+
+def retract_post(post):
+    TimelineEntry.objects.filter(post=post).delete()
+
+
+def backfill(owner, author):
+    """Copies the author's most recent posts into owner's timeline after a new follow."""
+    if owner != author and is_pull_author(author):
+        return
+
+    posts = Post.objects.filter(user_id=author).order_by(
+        '-post_date', '-post_id').values_list('post_id', 'post_date')[:TIMELINE_MAX_LENGTH]
+    TimelineEntry.objects.bulk_create(
+        [TimelineEntry(owner=owner, post_id=post_id, post_date=post_date)
+         for post_id, post_date in posts],
+        batch_size=1000, ignore_conflicts=True)
+    trim_timelines([owner.id])
+
+
+def purge(owner, author):
+    TimelineEntry.objects.filter(owner=owner, post__user_id=author).delete()
+
+
+def trim_timelines(owner_ids, batch_size=1000):
+    """Drops entries older than each owner's TIMELINE_MAX_LENGTH-th newest one."""
+    owner_ids = list(owner_ids)
+    oldest_kept = TimelineEntry.objects.filter(owner_id=OuterRef('owner_id')).order_by(
+        '-post_date').values('post_date')[TIMELINE_MAX_LENGTH - 1:TIMELINE_MAX_LENGTH]
+    for start in range(0, len(owner_ids), batch_size):
+        TimelineEntry.objects.filter(
+            owner_id__in=owner_ids[start:start + batch_size],
+            post_date__lt=Subquery(oldest_kept),
+        ).delete()
+
+
+def rebuild(user_profile):
+    TimelineEntry.objects.filter(owner=user_profile.user).delete()
+    backfill(user_profile.user, user_profile.user)
+    for author in user_profile.following.all():
+        backfill(user_profile.user, author)
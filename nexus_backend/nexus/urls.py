@@ -3,6 +3,7 @@
 from django.urls import path
 from .auth import auth_router as authapis
 from .homepage import hp_router as homepageapi
+from .images import image_router as imageapi
 from .posts import post_router as postsapi
 from .story import story_router as storyapi
 from .user import user_router as userapi
@@ -15,4 +16,5 @@ urlpatterns = [
     path("story/", storyapi.urls),
     path("user/", userapi.urls),
     path("chat/", message_router.urls),
+    path("images/", imageapi.urls),
 ]
@@ -1,3 +1,4 @@
+from asgiref.sync import sync_to_async
 from django.core.files.storage import default_storage
 from django.conf import settings
 from ninja import Query
@@ -5,8 +6,8 @@ from django.contrib.auth.models import User
 from django.core.files.base import ContentFile
 from .models import UserProfile, Post, Notification, Conversation
 from ninja import NinjaAPI
-from ninja.responses import Response
-from ninja_jwt.authentication import JWTAuth
+from .renderers import FastJSONParser, FastJSONRenderer, Response
+from .authentication import AsyncCachedJWTAuth, CachedJWTAuth, forget_user
 from ninja.errors import HttpError
 from ninja import Schema, File, Form,  UploadedFile
 from typing import Optional
@@ -14,16 +15,22 @@ from ninja import Body
 from .schema import UserSchema, UserSchema, SearchFollowSchema
 from django.contrib.auth.hashers import make_password
 from django.utils.timesince import timesince
+from django.utils import timezone
+from . import avatars, feed_cache, images, media, timeline
+from .avatars import aavatar_urls, avatar_urls, profile_avatar_url
+from .messaging import direct_conversation
+from .notifications import mark_seen, notification_text, notify, withdraw
+from .pagination import clamp_limit, decode_cursor, encode_cursor, keyset_before
 
-user_router = NinjaAPI(urls_namespace='userAPI')
+user_router = NinjaAPI(urls_namespace='userAPI', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 user_message = "User profile not found for one or both users."
 user_not_found_message = "User not found"
 
-user_router = NinjaAPI(urls_namespace='userAPI')
+user_router = NinjaAPI(urls_namespace='userAPI', renderer=FastJSONRenderer(), parser=FastJSONParser())
 
 
-@user_router.post("/edit-profile", auth=JWTAuth())
+@user_router.post("/edit-profile", auth=CachedJWTAuth())
 def edit_profile(request, 
                  username: str = Form(None), 
                  first_name: Optional[str] = Form(None), 
@@ -44,14 +51,32 @@ def edit_profile(request,
     if not any([username, first_name, last_name, bio, profile_picture, previous_password, new_password]):
         return Response({"error": "No data provided"}, status=400)
 
+    if profile_picture:
+        try:
+            media.check_upload(profile_picture)
+        except media.UploadRejected as e:
+            return Response({"error": str(e)}, status=e.status)
+
     try:
         update_user_details(request.user, username, first_name, last_name)
-        update_user_profile(user_profile, bio, profile_picture)
         if previous_password and new_password:
             handle_password_change(request.user, previous_password, new_password)
-
-        request.user.save()
-        user_profile.save()
+        # Stored only once everything else is valid, and the old picture let go only once the profile points
+        # at the new one, so a rejected edit neither leaks a blob reference nor frees one still in use.
+        replaced = update_user_profile(user_profile, bio, profile_picture)
+        try:
+            request.user.save()
+            user_profile.save()
+        except Exception:
+            if profile_picture:
+                media.discard(user_profile.profile_image.name)
+            raise
+        if replaced:
+            media.discard(*replaced)
+        forget_user(request.user.id)
+        if profile_picture:
+            avatars.invalidate(user_profile.user_id)
+            images.schedule('avatar', user_profile.pk)
 
         profile_picture_url = get_profile_picture_url(user_profile)
         
@@ -67,6 +92,9 @@ def edit_profile(request,
             }
         }, status=200)
 
+    except media.UploadRejected as e:
+        # Also a ValueError; the size limit can still trip while the picture streams to storage.
+        return Response({"error": str(e)}, status=e.status)
     except ValueError as e:
         return Response({"error": str(e)}, status=400)
 
@@ -85,16 +113,18 @@ def update_user_profile(user_profile, bio, profile_picture):
     if bio:
         user_profile.bio = bio
     if profile_picture:
-        save_profile_picture(user_profile, profile_picture)
+        return save_profile_picture(user_profile, profile_picture)
 
 def save_profile_picture(user_profile, profile_picture):
+    """Points the profile at the stored upload and returns the picture it replaced, for media.discard once saved."""
+    image_path = media.store_upload(profile_picture)
+    replaced = None
     if user_profile.profile_image:
-        user_profile.profile_image.delete(save=False)
-
-    extension = profile_picture.name.split(".")[-1]
-    image_name = f'profile_images/{user_profile.user.id}.{extension}'
-    image_path = default_storage.save(image_name, ContentFile(profile_picture.read()))
+        replaced = (user_profile.profile_image.name, user_profile.image_variants)
+    if image_path != user_profile.profile_image.name:
+        user_profile.image_variants = {}
     user_profile.profile_image = image_path
+    return replaced
 
 def handle_password_change(user, previous_password, new_password):
     if not user.check_password(previous_password):
@@ -102,11 +132,11 @@ def handle_password_change(user, previous_password, new_password):
     user.set_password(new_password)
 
 def get_profile_picture_url(user_profile):
-    return user_profile.profile_image.url if user_profile.profile_image else f"{settings.MEDIA_URL}profile_images/default.png"
+    return profile_avatar_url(user_profile)
 
 
 
-@user_router.post("/search-user", auth=JWTAuth())
+@user_router.post("/search-user", auth=CachedJWTAuth())
 def search_user(request, payload: UserSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -115,17 +145,15 @@ def search_user(request, payload: UserSchema) -> Response:
     if not payload.username.strip():
         return Response({"users": []}, status=200)
     
-    users = User.objects.filter(username__icontains=payload.username)
+    users = list(User.objects.filter(username__icontains=payload.username))
+    user_avatars = avatar_urls(user.id for user in users)
+    following_ids = set(request.user.following.filter(
+        id__in=[user.id for user in users]).values_list('id', flat=True))
 
     user_data = []
     for user in users:
-        user_profile = UserProfile.objects.get(
-            user=user) if hasattr(user, 'userprofile') else None
-        profile_picture_url = (
-            user_profile.profile_image.url if user_profile and user_profile.profile_image else f"{
-                settings.MEDIA_URL}profile_images/default.png"
-        )
-        is_following = request.user.following.filter(id=user.id).exists()
+        profile_picture_url = user_avatars[user.id]
+        is_following = user.id in following_ids
 
         user_data.append({
             "username": user.username,
@@ -138,8 +166,8 @@ def search_user(request, payload: UserSchema) -> Response:
     return Response({"users": user_data}, status=200)
 
 
-@user_router.post("/user-profile", auth=JWTAuth())
-def user_profile(request, payload: UserSchema) -> Response:
+@user_router.post("/user-profile", auth=AsyncCachedJWTAuth())
+async def user_profile(request, payload: UserSchema) -> Response:
     
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
@@ -150,33 +178,37 @@ def user_profile(request, payload: UserSchema) -> Response:
         return Response({"error": "Username is required"}, status=400)
 
     try:
-        searched_user = User.objects.get(username=username)
+        searched_user = await User.objects.aget(username=username)
     except User.DoesNotExist:
         return Response({"error": user_not_found_message}, status=404)
 
-    user_profile = UserProfile.objects.get(user=searched_user)
+    user_profile = await UserProfile.objects.aget(user=searched_user)
 
-    auth_user_profile = UserProfile.objects.get(user=request.user)
+    auth_user_profile = await UserProfile.objects.aget(user=request.user)
 
-    follows_searched_user = request.user in user_profile.followers.all()
+    follows_searched_user = await user_profile.followers.filter(id=request.user.id).aexists()
 
-    searched_user_follows = searched_user in auth_user_profile.followers.all()
+    searched_user_follows = await auth_user_profile.followers.filter(id=searched_user.id).aexists()
 
-    followers_count = user_profile.followers.all().count()
-    following_count = user_profile.following.all().count()
+    followers_count = await user_profile.followers.acount()
+    following_count = await user_profile.following.acount()
 
     posts_data = []
     if follows_searched_user or request.user == searched_user:  
-        posts = Post.objects.filter(user_id=searched_user)
+        posts = Post.objects.filter(user_id=searched_user).order_by('-post_date', '-post_id')
         posts_data = [
             {
                 "post_id": post.post_id,
-                "post_image": post.post_image.url if post.post_image else f"{settings.MEDIA_URL}posts/default.png"
+                "post_image": images.image_url(post.image_variants, 'full', post.post_image.url)
+                if post.post_image else f"{settings.MEDIA_URL}posts/default.png",
+                "post_image_variants": images.variant_urls(post.image_variants),
+                "likes_count": post.like_count,
+                "comments_count": post.comment_count
             }
-            for post in posts
+            async for post in posts
         ]
     is_requested = False
-    if (request.user in user_profile.pending_requests.all()):
+    if await user_profile.pending_requests.filter(id=request.user.id).aexists():
         is_requested = True
 
     user_is_himself = False
@@ -188,7 +220,7 @@ def user_profile(request, payload: UserSchema) -> Response:
         "first_name": searched_user.first_name,
         "last_name": searched_user.last_name,
         "bio": user_profile.bio,
-        "profile_picture": user_profile.profile_image.url if user_profile.profile_image else f"{settings.MEDIA_URL}profile_images/default.png",
+        "profile_picture": profile_avatar_url(user_profile),
         "posts": posts_data,
         "follows_searched_user": follows_searched_user,
         "searched_user_follows": searched_user_follows,
@@ -201,7 +233,7 @@ def user_profile(request, payload: UserSchema) -> Response:
     return Response({"user_profile": user_data}, status=200)
 
 
-@user_router.post("/unfollow", auth=JWTAuth())
+@user_router.post("/unfollow", auth=CachedJWTAuth())
 def unfollow_user(request, payload: UserSchema) -> Response:
     # Ensure the user is authenticated
     if not request.user.is_authenticated:
@@ -227,13 +259,16 @@ def unfollow_user(request, payload: UserSchema) -> Response:
     if request.user in unfollowed_user_profile.followers.all():
         unfollowed_user_profile.followers.remove(request.user)
 
+    timeline.purge(request.user, user_to_unfollow)
+    feed_cache.invalidate_viewers([request.user.id])
+
     return Response({
         "success": True,
         "message": f"You have successfully unfollowed {user_to_unfollow.username}."
     }, status=200)
 
 
-@user_router.post("/follow", auth=JWTAuth())
+@user_router.post("/follow", auth=CachedJWTAuth())
 def follow_user(request, payload: UserSchema) -> Response:
     
     if not request.user.is_authenticated:
@@ -257,13 +292,8 @@ def follow_user(request, payload: UserSchema) -> Response:
         followed_user_profile.pending_requests.add(request.user)
         followed_user_profile.save()
 
-        Notification.objects.create(
-            notify_from=request.user,
-            notify_to=user_to_follow,
-            notify_type="follow_request",
-            notify_text=f"{
-                request.user.username} has sent you a follow request."
-        )
+        notify(request.user, user_to_follow, "follow_request", f"{
+            request.user.username} has sent you a follow request.")
 
         return Response({
             "success": True,
@@ -272,13 +302,14 @@ def follow_user(request, payload: UserSchema) -> Response:
 
     followed_user_profile.pending_requests.remove(request.user)
     followed_user_profile.save()
+    withdraw(request.user, user_to_follow, "follow_request")
     return Response({
         "success": True,
         "message": f"You have cancelled a follow request to {user_to_follow.username}."
     }, status=200)
 
 
-@user_router.post("/cancel-request", auth=JWTAuth())
+@user_router.post("/cancel-request", auth=CachedJWTAuth())
 def cancel_request(request, payload: UserSchema) -> Response:
    
     if not request.user.is_authenticated:
@@ -297,11 +328,7 @@ def cancel_request(request, payload: UserSchema) -> Response:
 
     requester = User.objects.get(username=payload.username)
 
-    Notification.objects.filter(
-        notify_from=requester,
-        notify_to=request.user,
-        notify_type="follow_request"
-    ).delete()
+    withdraw(requester, request.user, "follow_request")
     user_profile.pending_requests.remove(requester)
     cancelled_user_profile.sent_requests.remove(request.user)
     cancelled_user_profile.save()
@@ -312,7 +339,7 @@ def cancel_request(request, payload: UserSchema) -> Response:
     }, status=200)
 
 
-@user_router.post("/accept-follow-request", auth=JWTAuth())
+@user_router.post("/accept-follow-request", auth=CachedJWTAuth())
 def accept_follow_request(request, payload: UserSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
@@ -331,11 +358,7 @@ def accept_follow_request(request, payload: UserSchema) -> Response:
     if requester not in user_profile.pending_requests.all():
         return Response({"success": False, "message": "No follow request from this user"}, status=400)
 
-    Notification.objects.filter(
-        notify_from=requester,
-        notify_to=request.user,
-        notify_type="follow_request"
-    ).delete()
+    withdraw(requester, request.user, "follow_request")
 
     user_profile.pending_requests.remove(
         requester) 
@@ -348,30 +371,14 @@ def accept_follow_request(request, payload: UserSchema) -> Response:
     user_profile.save()
     requester_profile.save()
 
-    Notification.objects.create(
-        notify_from=request.user,
-        notify_to=requester,
-        notify_type="Follow Accepted",
-        notify_text=f"{request.user.username} accepted your follow request"
-    )
-
-    Notification.objects.create(
-        notify_from=requester,
-        notify_to=request.user,
-        notify_type="Follow Request Accepted",
-        notify_text=f"You accepted the follow request from {
-            requester.username}"
-    )
-    existing_conversation = Conversation.objects.filter(
-        users=request.user
-    ).filter(
-        users=requester
-    ).first()
-
-    if not existing_conversation:
-        conversation = Conversation.objects.create()
-        conversation.users.add(request.user, requester)
-        conversation.save()
+    timeline.note_new_follower(request.user)
+    timeline.backfill(requester, request.user)
+    feed_cache.invalidate_viewers([requester.id])
+
+    notify(request.user, requester, "Follow Accepted", f"{request.user.username} accepted your follow request")
+    notify(requester, request.user, "Follow Request Accepted", f"You accepted the follow request from {
+        requester.username}")
+    direct_conversation(request.user, requester)
 
     return Response({
         "success": True,
@@ -379,39 +386,74 @@ def accept_follow_request(request, payload: UserSchema) -> Response:
     }, status=200)
 
 
-@user_router.get("/view-notifications", auth=JWTAuth())
-def view_notifications(request) -> Response:
+@user_router.get("/view-notifications", auth=AsyncCachedJWTAuth())
+async def view_notifications(request, before: str = None, limit: int = None) -> Response:
 
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
 
-    notifications = Notification.objects.filter(notify_to=request.user).order_by(
-        '-notify_time') 
+    limit = clamp_limit(limit)
+    opened_at = timezone.now()
+
+    notifications = Notification.objects.filter(notify_to=request.user).select_related(
+        'notify_from', 'notify_post').order_by('-notify_time', '-notification_id')
+    if before:
+        try:
+            notifications = notifications.filter(
+                keyset_before('notify_time', 'notification_id', *decode_cursor(before)))
+        except ValueError:
+            return Response({"error": "Invalid cursor"}, status=400)
+
+    # One extra row tells us whether another page exists.
+    page = [notification async for notification in notifications[:limit + 1]]
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(page[-1].notify_time, page[-1].notification_id)
+    sender_avatars = await aavatar_urls(notification.notify_from_id for notification in page)
+
+    if not before:
+        await sync_to_async(mark_seen)(request.user, opened_at)
 
     response_data = []
 
-    for notification in notifications:
-        profile = UserProfile.objects.get(user=notification.notify_from)
+    for notification in page:
         post_url = None
         if (notification.notify_type == "like" or notification.notify_type == "comment"):
-            notified_post = Post.objects.get(
-                post_id=notification.notify_post.post_id)
-            post_url = notified_post.post_image.url
+            notified_post = notification.notify_post
+            post_url = notified_post.post_image.url if notified_post.post_image else None
+            # A thumbnail is all the inbox row shows.
+            post_url = images.variant_urls(notified_post.image_variants).get('thumb', post_url)
         response_data.append({
             "notify_from": notification.notify_from.username,
-            "notify_text": notification.notify_text,
+            "notify_text": notification_text(notification),
+            "actor_count": notification.actor_count,
             "notify_date": timesince(notification.notify_time) + " ago",
             "notify_type": notification.notify_type,
             "post_id": notification.notify_post.post_id if notification.notify_post else None,
-            "profile_picture": profile.profile_image.url if profile.profile_image else f"{settings.MEDIA_URL}profile_images/default.png",
+            "profile_picture": sender_avatars[notification.notify_from_id],
             "post_image": post_url
 
         })
 
-    return Response(response_data, status=200)
+    return Response({"notifications": response_data, "next_cursor": next_cursor}, status=200)
+
+
+@user_router.get("/unread-notifications", auth=AsyncCachedJWTAuth())
+async def unread_notifications(request) -> Response:
+
+    if not request.user.is_authenticated:
+        return Response({"error": "Unauthorized"}, status=401)
+
+    unread_count = await UserProfile.objects.filter(
+        user=request.user).values_list('unread_notifications', flat=True).afirst()
+    if unread_count is None:
+        return Response({"error": "User profile not found"}, status=404)
+
+    return Response({"unread_count": unread_count}, status=200)
 
 
-@user_router.post("/search-followers", auth=JWTAuth())
+@user_router.post("/search-followers", auth=CachedJWTAuth())
 def search_followers_of_user(request, payload: SearchFollowSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
@@ -428,25 +470,20 @@ def search_followers_of_user(request, payload: SearchFollowSchema) -> Response:
     filtered_followers = followers.filter(
         username__icontains=payload.search_string)
 
+    filtered_followers = list(filtered_followers)
+    follower_avatars = avatar_urls(user.id for user in filtered_followers)
+
     followers_data = []
     for user in filtered_followers:
-        user_profile = UserProfile.objects.get(
-            user=user) if hasattr(user, 'userprofile') else None
-        profile_picture_url = (
-            user_profile.profile_image.url
-            if user_profile and user_profile.profile_image
-            else f"{settings.MEDIA_URL}profile_images/default.png"
-        )
-
         followers_data.append({
-            "username": user_profile.user.username,
-            "profile_picture": profile_picture_url,
+            "username": user.username,
+            "profile_picture": follower_avatars[user.id],
         })
 
     return Response({"followers": followers_data}, status=200)
 
 
-@user_router.post("/search-following", auth=JWTAuth())
+@user_router.post("/search-following", auth=CachedJWTAuth())
 def search_following_of_user(request, payload: SearchFollowSchema) -> Response:
 
     if not request.user.is_authenticated:
@@ -464,26 +501,21 @@ def search_following_of_user(request, payload: SearchFollowSchema) -> Response:
     filtered_following = following.filter(
         username__icontains=payload.search_string)
 
+    filtered_following = list(filtered_following)
+    following_avatars = avatar_urls(user.id for user in filtered_following)
+
     following_data = []
     for user in filtered_following:
-        user_profile = UserProfile.objects.get(
-            user=user) if hasattr(user, 'userprofile') else None
-        profile_picture_url = (
-            user_profile.profile_image.url
-            if user_profile and user_profile.profile_image
-            else f"{settings.MEDIA_URL}profile_images/default.png"
-        )
-
         following_data.append({
-            "username": user_profile.user.username,
-            "profile_picture": profile_picture_url,
+            "username": user.username,
+            "profile_picture": following_avatars[user.id],
         })
 
     return Response({"following": following_data}, status=200)
 
 
 
-@user_router.post("/remove-follower", auth=JWTAuth())
+@user_router.post("/remove-follower", auth=CachedJWTAuth())
 def remove_follower(request, payload: UserSchema) -> Response:
     if not request.user.is_authenticated:
         return Response({"error": "Unauthorized"}, status=401)
@@ -503,6 +535,8 @@ def remove_follower(request, payload: UserSchema) -> Response:
         
         target_profile = UserProfile.objects.get(user=target_user)
         target_profile.following.remove(request.user)
+        timeline.purge(target_user, request.user)
+        feed_cache.invalidate_viewers([target_user.id])
 
         return Response({
             "message": f"{payload.username} has been removed from your followers.",
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 from decouple import config
 from datetime import timedelta
 
@@ -26,7 +27,7 @@ SECRET_KEY = config('secretkey')
 
 
 # SECURITY WARNING: don't run with debug turned on in production!
-
+DEBUG = config('DEBUG', default=False, cast=bool)
 
 ALLOWED_HOSTS = []
 
@@ -147,6 +148,65 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Store session data in the database
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 
+# Shared cache, required in production: feed cache invalidations and the like
+# count overlay must reach every worker. Without CACHE_URL, per-process memory
+# is used only when LOCAL_CACHE is set (default: DEBUG), e.g. for tests, CI and
+# management commands on a development machine
+CACHE_URL = config('CACHE_URL', default='')
+LOCAL_CACHE = config('LOCAL_CACHE', default=DEBUG, cast=bool)
+if not CACHE_URL and not LOCAL_CACHE:
+    raise ImproperlyConfigured('CACHE_URL must point at the shared Redis cache unless LOCAL_CACHE or DEBUG is set')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_URL,
+    } if CACHE_URL else {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# New chat messages reach open sockets through Redis when it is configured,
+# otherwise only within this process
+CHAT_PUBSUB_BACKEND = 'nexus.pubsub.RedisPubSub' if CACHE_URL else 'nexus.pubsub.InProcessPubSub'
+CHAT_PUBSUB_URL = CACHE_URL
+
+# Serialized home feed pages live this long unless an event invalidates them
+FEED_CACHE_TIMEOUT = 300
+
+# Follower feed versions moved per cache round trip when a post changes
+FEED_CACHE_INVALIDATION_BATCH = 1000
+
+# Authenticated users are served from an in-process cache for this many seconds
+AUTH_USER_CACHE_TTL = 30
+# Revoked token ids are re-read from the blacklist at most this often
+AUTH_REVOCATION_REFRESH = 5
+# Blacklist ids skipped by a refresh are looked for again this many seconds, in case they commit late
+AUTH_REVOCATION_GAP_TIMEOUT = 60
+
+# Likes and comments on a post within this many seconds share one notification
+NOTIFICATION_GROUP_WINDOW = 24 * 60 * 60
+# Deliver queued notifications inline instead of through Celery, for running without a broker
+NOTIFICATION_OUTBOX_EAGER = config('NOTIFICATION_OUTBOX_EAGER', default=False, cast=bool)
+# Outbox events delivered per transaction by the drain task
+NOTIFICATION_OUTBOX_BATCH = 500
+# Notifications older than this many days, or beyond this many per user, are deleted daily
+NOTIFICATION_RETENTION_DAYS = 90
+NOTIFICATION_RETENTION_PER_USER = 500
+
+# Story views are buffered in memory per process and written in batches of this size, or at least
+# every this many seconds by a background thread; view counts lag by up to that interval
+STORY_VIEW_BUFFER_SIZE = 500
+STORY_VIEW_FLUSH_INTERVAL = 1
+# Each viewer's own pending views are also kept this long in the shared cache, so their next
+# read on any worker sees them
+STORY_VIEW_SHARED_TIMEOUT = 60
+# Expired stories are deleted in chunks of this size, with media files removed by this many threads
+STORY_EXPIRY_BATCH = 500
+STORY_MEDIA_DELETE_WORKERS = 8
+
+# Threads available to async handlers for password hashing and media writes
+BLOCKING_EXECUTOR_WORKERS = 4
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework_simplejwt.authentication.JWTAuthentication',
@@ -172,8 +232,47 @@ import os
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Uploaded images larger than this are rejected; accepted ones are copied to storage in chunks of this size
+MEDIA_UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+MEDIA_UPLOAD_CHUNK_SIZE = 64 * 1024
+# Longest side in pixels of the variants generated for every uploaded image, and their JPEG quality
+MEDIA_VARIANTS = {'thumb': 150, 'medium': 640, 'full': 1080}
+MEDIA_VARIANT_QUALITY = 85
+# Encodings stored for every variant, most preferred first; media responses pick one from the Accept header.
+# Formats this Pillow build cannot write are skipped, and JPEG is always kept as the fallback
+MEDIA_VARIANT_FORMATS = ['avif', 'webp', 'jpeg']
+MEDIA_VARIANT_MAX_AGE = 24 * 60 * 60
+# Images with more pixels than this are never decoded
+MEDIA_MAX_PIXELS = 40_000_000
+# Generate variants inline instead of through Celery, for running without a broker
+MEDIA_VARIANTS_EAGER = config('MEDIA_VARIANTS_EAGER', default=False, cast=bool)
 
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'UTC'
\ No newline at end of file
+CELERY_TIMEZONE = 'UTC'
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'compact-tokens': {
+        'task': 'nexus.tasks.compact_tokens',
+        'schedule': timedelta(hours=6),
+    },
+    # Sweeps up outbox events whose drain could not be scheduled when they were queued
+    'drain-notifications': {
+        'task': 'nexus.tasks.drain_notifications',
+        'schedule': timedelta(minutes=1),
+    },
+    'compact-notifications': {
+        'task': 'nexus.tasks.compact_notifications',
+        'schedule': timedelta(days=1),
+    },
+    'expire-stories': {
+        'task': 'nexus.tasks.expire_stories',
+        'schedule': timedelta(minutes=5),
+    },
+}
+
+# Home timelines are materialized on write up to this many entries per user.
+TIMELINE_MAX_LENGTH = 800
+# Authors with more followers than this are merged into feeds at read time.
+TIMELINE_FANOUT_FOLLOWER_LIMIT = 5000